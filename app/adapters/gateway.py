@@ -1,53 +1,287 @@
-from typing import Any, List
-from dataclasses import dataclass
+import io
+import csv
+import asyncio
+import json
+import zlib
+import logging
+from datetime import datetime
+from dataclasses import dataclass, field
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Set
+)
 
 from app.entities.models import (
     ServiceModel,
     ServiceUpdateModel,
+    ServiceDeltaModel,
+    ServicePriceAdjustmentModel,
+    PriceAdjustmentResultModel,
     ProductModel,
     ProductResponseSearchModel,
+    ProductSearchItem,
     ServiceDictModel,
     ProducDictModel,
-    MessageType
+    MessageType,
+    ExportFormat
 )
+from app import deadline
 from app.config import Config
+from app.metrics import Counter
+from app.adapters.cache import TTLCache
+from app.adapters.popularity import HeavyHitters
 from app.adapters.gateway_i import GatewayInterface
+from app.errors import ElementNotFoundError, VersionConflictError
+from app.adapters.mappers import extract_syscom_product, map_syscom_products
 from app.infrastructure.repository_i import RepositoryInterface
 
 from pydantic import BaseSettings
 from fastapi.encoders import jsonable_encoder
 
+log = logging.getLogger(__name__)
+
+SEARCH_PRODUCT = "product"
+SEARCH_SERVICE_NAME = "service_name"
+SEARCH_SERVICE_DESCRIPTION = "service_description"
+SERVICE_SEARCHES = (SEARCH_SERVICE_NAME, SEARCH_SERVICE_DESCRIPTION)
+MISSING = object()
+REMOTE_PRODUCT_LAYER = "remote_product"
+
+search_cache_requests = Counter(
+    "search_cache_requests_total",
+    "Search cache lookups, by search kind and result"
+)
+
+SERVICE_EXPORT_FIELDS = tuple(ServiceDictModel.__annotations__)
+PRODUCT_EXPORT_FIELDS = tuple(ProducDictModel.__annotations__)
+EXPORT_CHUNK_SIZE = 64 * 1024
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
 
 @dataclass
 class Gateway(GatewayInterface):
 
     repository: RepositoryInterface
     conf: BaseSettings = Config()
+    search_caches: Dict[str, TTLCache] = field(init=False)
+    popular_searches: HeavyHitters = field(init=False)
+    remote_products: Dict[str, asyncio.Future] = field(
+        init=False,
+        default_factory=dict
+    )
+    background_tasks: Set[asyncio.Future] = field(
+        init=False,
+        default_factory=set
+    )
+
+    def __post_init__(self):
+        product_cache = TTLCache(
+            self.conf.search_cache_size,
+            self.conf.product_search_cache_ttl_s
+        )
+        self.search_caches = {SEARCH_PRODUCT: product_cache}
+        for kind in SERVICE_SEARCHES:
+            self.search_caches[kind] = TTLCache(
+                self.conf.search_cache_size,
+                self.conf.service_search_cache_ttl_s
+            )
+        self.popular_searches = HeavyHitters(
+            self.conf.popular_queries_capacity
+        )
 
     async def get_service(self, service_id: int) -> ServiceDictModel:
         return await self.repository.get_service_data(service_id)
 
-    async def get_product(self, product_id: int) -> ProducDictModel:
-        return await self.repository.get_product_data(product_id)
+    async def get_product(self, product_id: str) -> ProducDictModel:
+        try:
+            return await self.repository.get_product_data(product_id)
+        except ElementNotFoundError:
+            if not product_id.isdigit():
+                raise
+        return await self._remote_product(product_id)
 
-    async def search_product(self, word: str) -> List[ProducDictModel]:
-        response = await self.repository.search_products(word)
-        return await self._map_response_to_model(response)
+    async def get_products(
+        self,
+        product_ids: List[str]
+    ) -> List[ProducDictModel]:
+        local = await self.repository.get_products_data(product_ids)
+        found = {}
+        for product in local:
+            found[product["_id"]] = product
+            found[str(product.get("product_id"))] = product
+        missing = [
+            pid for pid in dict.fromkeys(product_ids)
+            if pid not in found and pid.isdigit()
+        ]
+        remote = await asyncio.gather(
+            *[self._remote_product(pid) for pid in missing],
+            return_exceptions=True
+        )
+        for pid, product in zip(missing, remote):
+            if isinstance(product, Exception):
+                log.error(f"Could not get product {pid}: {product}")
+                continue
+            found[pid] = product
+        return [found[pid] for pid in product_ids if pid in found]
+
+    async def search_product(self, word: str) -> List[ProductSearchItem]:
+        return await self._cached_search(SEARCH_PRODUCT, word)
 
     async def search_services_by_name(
         self,
         service_name: str
     ) -> List[ServiceDictModel]:
-        return await self.repository.search_services_by_name(service_name)
+        return await self._cached_search(SEARCH_SERVICE_NAME, service_name)
 
     async def search_services_by_description(
         self,
         service_description: str
     ) -> List[ServiceDictModel]:
-        return await self.repository.search_services_by_description(
+        return await self._cached_search(
+            SEARCH_SERVICE_DESCRIPTION,
             service_description
         )
 
+    async def restore_query_stats(self):
+        snapshot = await self.repository.load_query_stats()
+        self.popular_searches.restore(snapshot)
+
+    async def save_query_stats(self):
+        await self.repository.save_query_stats(
+            self.popular_searches.snapshot()
+        )
+
+    def decay_query_stats(self):
+        self.popular_searches.decay()
+
+    async def refresh_popular_searches(self, horizon: float, spread: float):
+        """Reload the most popular searches that are not cached or expire
+        within horizon seconds, so their users keep hitting the cache.
+        Reloads are spaced evenly over spread seconds"""
+        top_searches = self.popular_searches.top(
+            self.conf.popular_queries_top_k
+        )
+        due = []
+        for popular_key, _ in top_searches:
+            kind, key = popular_key.split(":", 1)
+            cache = self.search_caches.get(kind)
+            if cache is None:
+                continue
+            expires_in = cache.expires_in(key)
+            if expires_in is None or expires_in <= horizon:
+                # Reload with the term as it was searched, not its key
+                term = self.popular_searches.value(popular_key)
+                if term is None:
+                    term = key
+                due.append((popular_key, kind, key, term, cache))
+        for position, (popular_key, kind, key, term, cache) in enumerate(due):
+            if position:
+                await asyncio.sleep(spread / len(due))
+            try:
+                cache.set(key, await self._search_loader(kind)(term))
+            except Exception as e:
+                log.error(
+                    f"Could not refresh popular search {popular_key}: {e}"
+                )
+
+    def _search_loader(self, kind: str) -> Callable[[str], Awaitable[Any]]:
+        if kind == SEARCH_PRODUCT:
+            return self._load_products
+        if kind == SEARCH_SERVICE_NAME:
+            return self.repository.search_services_by_name
+        return self.repository.search_services_by_description
+
+    async def _load_products(self, word: str) -> List[ProductSearchItem]:
+        response = await self.repository.search_products(word)
+        return await self._map_response_to_model(response)
+
+    async def _cached_search(self, kind: str, term: str) -> List[Any]:
+        key = self._search_key(kind, term)
+        self.popular_searches.record(f"{kind}:{key}", term)
+        cache = self.search_caches[kind]
+        found = cache.get(key, MISSING)
+        if found is not MISSING:
+            search_cache_requests.inc(kind=kind, result="hit")
+            return found
+        search_cache_requests.inc(kind=kind, result="miss")
+        found = await self._search_loader(kind)(term)
+        cache.set(key, found)
+        return found
+
+    @staticmethod
+    def _search_key(kind: str, term: str) -> str:
+        # Catalog searches are case insensitive, share one entry for every
+        # casing. Service terms are regexes, where casing changes escapes
+        # like \S into \s, so they only share an entry when equal
+        if kind == SEARCH_PRODUCT:
+            return term.strip().casefold()
+        return term
+
+    async def _remote_product(self, product_id: str) -> ProducDictModel:
+        # Concurrent misses for the same product share a single fetch
+        pending = self.remote_products.get(product_id)
+        if pending is None:
+            pending = asyncio.ensure_future(
+                self._load_remote_product(product_id)
+            )
+            self.remote_products[product_id] = pending
+        # Every caller waits within its own budget, the shared fetch
+        # keeps going for the ones that still have time left
+        try:
+            return await asyncio.wait_for(
+                asyncio.shield(pending),
+                deadline.remaining(REMOTE_PRODUCT_LAYER)
+            )
+        except asyncio.TimeoutError:
+            raise deadline.exceeded(REMOTE_PRODUCT_LAYER)
+
+    async def _load_remote_product(self, product_id: str) -> ProducDictModel:
+        # Runs in its own task context, so it must not inherit the
+        # deadline of whichever caller happened to start it
+        deadline.start(self.conf.max_deadline_ms)
+        try:
+            raw_product = await self.repository.fetch_product(product_id)
+            product = extract_syscom_product(raw_product).to_model()
+        except Exception:
+            self.remote_products.pop(product_id, None)
+            raise
+        # Lookups keep sharing this result until the product is stored
+        persist = asyncio.ensure_future(
+            self._persist_product(product_id, product)
+        )
+        self.background_tasks.add(persist)
+        persist.add_done_callback(self.background_tasks.discard)
+        return jsonable_encoder(product)
+
+    async def _persist_product(self, product_id: str, product: ProductModel):
+        try:
+            if self.conf.stream_consume:
+                await self.repository.notify(product, MessageType.product)
+            else:
+                await self.repository.save_product(product)
+        except Exception as e:
+            log.error(f"Could not store product {product_id}: {e}")
+        finally:
+            self.remote_products.pop(product_id, None)
+
+    def _invalidate_service_searches(self):
+        for kind in SERVICE_SEARCHES:
+            self.search_caches[kind].clear()
+
+    async def autocomplete_services(
+        self,
+        prefix: str,
+        limit: int
+    ) -> List[ServiceDictModel]:
+        return await self.repository.autocomplete_services(prefix, limit)
+
     async def create_service(self, service: ServiceModel) -> ServiceDictModel:
         if self.conf.stream_consume:
             service_type = MessageType.service
@@ -55,6 +289,7 @@ class Gateway(GatewayInterface):
             response = jsonable_encoder(service)
         else:
             response = await self.repository.create_service(service)
+        self._invalidate_service_searches()
         return response
 
     async def create_product(self, product: Any) -> ProducDictModel:
@@ -69,44 +304,179 @@ class Gateway(GatewayInterface):
     async def modify_service(
         self,
         service_id: str,
-        service: ServiceUpdateModel
+        service: ServiceUpdateModel,
+        expected_version: Optional[int] = None
     ) -> ServiceDictModel:
         if self.conf.stream_consume:
-            service_got = await self.repository.get_service_data(service_id)
-            service_model = ServiceModel(**service_got)
-            new_service_data = service.dict(exclude_unset=True)
-            updated_service = service_model.copy(update=new_service_data)
-            service_type = MessageType.service
-            await self.repository.notify(
-                updated_service,
-                service_type
+            version = await self.repository.get_service_version(service_id)
+            if expected_version is not None and expected_version != version:
+                raise VersionConflictError(
+                    f"Service {service_id} is not in version {expected_version}"  # noqa
+                )
+            changes = service.dict(exclude_unset=True)
+            if not changes:
+                # Nothing to publish, the version stays as it is
+                return {"_id": service_id, "version": version}
+            # Only the changed fields travel, the consumer applies them
+            delta = ServiceDeltaModel(
+                id=service_id,
+                changes=changes,
+                expected_version=expected_version
             )
-            updated_service = jsonable_encoder(updated_service)
+            await self.repository.notify(delta, MessageType.service_update)
+            updated_service = {
+                "_id": service_id,
+                **jsonable_encoder(changes),
+                "version": version + 1
+            }
         else:
-            await self.repository.update_service(
+            updated_service = await self.repository.update_service(
                 service_id,
-                service
-            )
-            updated_service = await self.repository.get_service_data(
-                service_id
+                service,
+                expected_version
             )
+        self._invalidate_service_searches()
         return updated_service
 
+    async def adjust_service_prices(
+        self,
+        adjustment: ServicePriceAdjustmentModel
+    ) -> PriceAdjustmentResultModel:
+        if adjustment.dry_run:
+            matched = await self.repository.count_services_to_adjust(
+                adjustment
+            )
+            return PriceAdjustmentResultModel(
+                matched=matched,
+                modified=0,
+                dry_run=True
+            )
+        if self.conf.stream_consume:
+            matched = await self._publish_price_adjustment(adjustment)
+            modified = matched
+        else:
+            matched, modified = await self.repository.adjust_service_prices(
+                adjustment
+            )
+        self._invalidate_service_searches()
+        return PriceAdjustmentResultModel(
+            matched=matched,
+            modified=modified,
+            dry_run=False
+        )
+
+    async def _publish_price_adjustment(
+        self,
+        adjustment: ServicePriceAdjustmentModel
+    ) -> int:
+        """Publish the new prices of each matched service as deltas, in
+        batches of notify_batch_size messages"""
+        published = 0
+        batch = []
+        services = self.repository.find_services_to_adjust(adjustment)
+        async for service in services:
+            batch.append(ServiceDeltaModel(
+                id=service["_id"],
+                changes=adjustment.apply(service),
+                expected_version=service.get("version", 0)
+            ))
+            if len(batch) == self.conf.notify_batch_size:
+                await self.repository.notify_many(
+                    batch,
+                    MessageType.service_update
+                )
+                published += len(batch)
+                batch = []
+        if batch:
+            await self.repository.notify_many(
+                batch,
+                MessageType.service_update
+            )
+            published += len(batch)
+        return published
+
+    def export_services(
+        self,
+        export_format: ExportFormat,
+        since_id: Optional[str] = None,
+        since: Optional[datetime] = None
+    ) -> AsyncIterator[bytes]:
+        documents = self.repository.export_services(since_id, since)
+        return self._encode_export(
+            documents,
+            export_format,
+            SERVICE_EXPORT_FIELDS
+        )
+
+    def export_products(
+        self,
+        export_format: ExportFormat,
+        since_id: Optional[str] = None,
+        since: Optional[datetime] = None
+    ) -> AsyncIterator[bytes]:
+        documents = self.repository.export_products(since_id, since)
+        return self._encode_export(
+            documents,
+            export_format,
+            PRODUCT_EXPORT_FIELDS
+        )
+
+    async def _encode_export(
+        self,
+        documents: AsyncIterator[dict],
+        export_format: ExportFormat,
+        fields: Sequence[str]
+    ) -> AsyncIterator[bytes]:
+        """Serialize documents as they come from the cursor and gzip them
+        in bounded chunks, so memory does not grow with the collection"""
+        compressor = zlib.compressobj(
+            self.conf.export_compress_level,
+            zlib.DEFLATED,
+            GZIP_WBITS
+        )
+        buffer = io.StringIO()
+        writer = None
+        if export_format == ExportFormat.csv:
+            writer = csv.DictWriter(
+                buffer,
+                fieldnames=fields,
+                extrasaction="ignore"
+            )
+            writer.writeheader()
+        # Every chunk is sync flushed, so whatever the client received
+        # decompresses completely up to exported_id
+        last_id = exported_id = None
+        try:
+            async for document in documents:
+                if writer is not None:
+                    writer.writerow(document)
+                else:
+                    buffer.write(json.dumps(document, default=str))
+                    buffer.write("\n")
+                last_id = document.get("_id")
+                if buffer.tell() >= EXPORT_CHUNK_SIZE:
+                    chunk = (
+                        compressor.compress(buffer.getvalue().encode("utf-8"))
+                        + compressor.flush(zlib.Z_SYNC_FLUSH)
+                    )
+                    buffer.seek(0)
+                    buffer.truncate()
+                    exported_id = last_id
+                    yield chunk
+        except Exception as e:
+            # The gzip stream is left unfinished on purpose, so clients
+            # notice the file is incomplete instead of getting a short one
+            log.error(
+                f"Export interrupted, resume with since_id={exported_id}: {e}"
+            )
+            raise
+        yield (
+            compressor.compress(buffer.getvalue().encode("utf-8"))
+            + compressor.flush()
+        )
+
     async def _map_response_to_model(
         self,
         raw_data: List[ProductResponseSearchModel]
-    ) -> List[ProductModel]:
-        return [
-            ProductModel(
-                title=prs.get("titulo"),
-                list_price=prs.get("precios").get("precio_lista"),
-                discount_price=prs.get("precios").get("precio_descuento"),
-                image=prs.get("img_portada"),
-                stock_number=prs.get("existencia").get("nuevo"),
-                brand=prs.get("marca"),
-                product_id=prs.get("producto_id"),
-                model=prs.get("modelo"),
-                sat_key=prs.get("sat_key"),
-                weight=prs.get("peso"),
-            ) for prs in raw_data
-        ]
+    ) -> List[ProductSearchItem]:
+        return map_syscom_products(raw_data or [])
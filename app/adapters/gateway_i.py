@@ -1,4 +1,5 @@
-from typing import Any, List
+from datetime import datetime
+from typing import Any, AsyncIterator, List, Optional
 from abc import ABC, abstractmethod
 
 
@@ -16,8 +17,9 @@ class GatewayInterface(ABC):
         """
 
     @abstractmethod
-    async def get_product(self, product_id: int) -> Any:
-        """Get information about a product
+    async def get_product(self, product_id: str) -> Any:
+        """Get information about a product, from the catalog provider when
+        it is not stored yet
 
         Args:
             product_id (int): product id
@@ -26,6 +28,17 @@ class GatewayInterface(ABC):
             Any: Information about the product
         """
 
+    @abstractmethod
+    async def get_products(self, product_ids: List[str]) -> List[Any]:
+        """Get information about several products
+
+        Args:
+            product_ids (List[str]): product ids
+
+        Returns:
+            List[Any]: products found, in the requested order
+        """
+
     @abstractmethod
     async def search_product(self, word: str) -> List[Any]:
         """Word to search into product catalog
@@ -62,6 +75,43 @@ class GatewayInterface(ABC):
             List[Any]: List of services matches
         """
 
+    @abstractmethod
+    async def autocomplete_services(
+        self,
+        prefix: str,
+        limit: int
+    ) -> List[Any]:
+        """Suggest services whose name starts with a prefix
+
+        Args:
+            prefix (str): start of the service name
+            limit (int): max number of suggestions
+
+        Returns:
+            List[Any]: services ordered by name
+        """
+
+    @abstractmethod
+    async def restore_query_stats(self):
+        """Load the saved search popularity into memory"""
+
+    @abstractmethod
+    async def save_query_stats(self):
+        """Persist the search popularity kept in memory"""
+
+    @abstractmethod
+    def decay_query_stats(self):
+        """Reduce the weight of past searches"""
+
+    @abstractmethod
+    async def refresh_popular_searches(self, horizon: float, spread: float):
+        """Reload popular searches before their cached results expire
+
+        Args:
+            horizon (float): seconds ahead of expiration to reload them
+            spread (float): seconds to space the reloads over
+        """
+
     @abstractmethod
     async def create_service(self, service: Any) -> Any:
         """Create a new service in DB
@@ -74,15 +124,22 @@ class GatewayInterface(ABC):
         """
 
     @abstractmethod
-    async def modify_service(self, service_id: str, service: Any) -> Any:
+    async def modify_service(
+        self,
+        service_id: str,
+        service: Any,
+        expected_version: Optional[int] = None
+    ) -> Any:
         """Update an existing service
 
         Args:
             service_id (str): service id to update
             service (Any): service to update
+            expected_version (Optional[int]): version the client read, the
+                update is rejected when the service changed since then
 
         Returns:
-            Any: Service modified
+            Any: Service modified, at least its id, changes and new version
         """
 
     @abstractmethod
@@ -95,3 +152,52 @@ class GatewayInterface(ABC):
         Returns:
             Any: product created
         """
+
+    @abstractmethod
+    async def adjust_service_prices(self, adjustment: Any) -> Any:
+        """Change the prices of every service matching a filter at once
+
+        Args:
+            adjustment (Any): filter, operation and whether it is a dry run
+
+        Returns:
+            Any: services matched and modified
+        """
+
+    @abstractmethod
+    def export_services(
+        self,
+        export_format: Any,
+        since_id: Optional[str] = None,
+        since: Optional[datetime] = None
+    ) -> AsyncIterator[bytes]:
+        """Stream every service as a gzip compressed file
+
+        Args:
+            export_format (Any): file format, NDJSON or CSV
+            since_id (Optional[str]): only services created after this id
+            since (Optional[datetime]): only services created or changed
+                since this date
+
+        Returns:
+            AsyncIterator[bytes]: gzip compressed chunks
+        """
+
+    @abstractmethod
+    def export_products(
+        self,
+        export_format: Any,
+        since_id: Optional[str] = None,
+        since: Optional[datetime] = None
+    ) -> AsyncIterator[bytes]:
+        """Stream every product as a gzip compressed file
+
+        Args:
+            export_format (Any): file format, NDJSON or CSV
+            since_id (Optional[str]): only products created after this id
+            since (Optional[datetime]): only products created or changed
+                since this date
+
+        Returns:
+            AsyncIterator[bytes]: gzip compressed chunks
+        """
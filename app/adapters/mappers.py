@@ -0,0 +1,53 @@
+from typing import Callable, List, Optional, Sequence, Tuple
+
+from app.entities.models import ProductResponseSearchModel, ProductSearchItem
+
+
+EMPTY_SOURCE: dict = {}
+
+# Where each ProductSearchItem slot lives in a Syscom product, in slot
+# order: (nested object or None for the top level, key, type to coerce to)
+SYSCOM_PRODUCT_PLAN: Tuple[Tuple[Optional[str], str, Callable], ...] = (
+    (None, "titulo", str),
+    ("precios", "precio_lista", float),
+    ("precios", "precio_descuento", float),
+    (None, "img_portada", str),
+    ("existencia", "nuevo", int),
+    (None, "marca", str),
+    (None, "producto_id", int),
+    (None, "modelo", str),
+    (None, "sat_key", int),
+    (None, "peso", float),
+)
+
+
+def compile_plan(
+    plan: Sequence[Tuple[Optional[str], str, Callable]]
+) -> Callable[[ProductResponseSearchModel], ProductSearchItem]:
+    """Resolve a field plan once so each product only looks up every nested
+    object a single time, instead of once per field"""
+    parents = tuple(dict.fromkeys(parent for parent, _, _ in plan if parent))
+    steps = tuple(
+        (parents.index(parent) + 1 if parent else 0, key, convert)
+        for parent, key, convert in plan
+    )
+
+    def extract(raw: ProductResponseSearchModel) -> ProductSearchItem:
+        get = raw.get
+        sources = (raw,) + tuple(get(parent) or EMPTY_SOURCE for parent in parents)  # noqa
+        values = []
+        for source, key, convert in steps:
+            value = sources[source].get(key)
+            values.append(None if value is None else convert(value))
+        return ProductSearchItem(*values)
+
+    return extract
+
+
+extract_syscom_product = compile_plan(SYSCOM_PRODUCT_PLAN)
+
+
+def map_syscom_products(
+    raw_data: List[ProductResponseSearchModel]
+) -> List[ProductSearchItem]:
+    return [extract_syscom_product(raw) for raw in raw_data]
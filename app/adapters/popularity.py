@@ -0,0 +1,61 @@
+from typing import Dict, List, Optional, Tuple
+
+
+class HeavyHitters:
+    """Space-Saving sketch: approximate counts of the most frequent keys
+    using at most capacity counters, however many distinct keys are seen.
+    Each key keeps the last value recorded along with it"""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.counts: Dict[str, int] = {}
+        self.values: Dict[str, Optional[str]] = {}
+
+    def record(self, key: str, value: Optional[str] = None):
+        counts = self.counts
+        if key in counts:
+            counts[key] += 1
+        elif len(counts) < self.capacity:
+            counts[key] = 1
+        else:
+            # The new key inherits the evicted count, so it may be
+            # overestimated but a frequent key is never missed
+            evicted = min(counts, key=counts.__getitem__)
+            counts[key] = counts.pop(evicted) + 1
+            self.values.pop(evicted, None)
+        self.values[key] = value
+
+    def value(self, key: str) -> Optional[str]:
+        return self.values.get(key)
+
+    def top(self, k: int) -> List[Tuple[str, int]]:
+        return sorted(
+            self.counts.items(),
+            key=lambda item: item[1],
+            reverse=True
+        )[:k]
+
+    def decay(self):
+        """Halve every count so old popular keys fade away"""
+        self.counts = {
+            key: count // 2
+            for key, count in self.counts.items()
+            if count > 1
+        }
+        self.values = {key: self.values.get(key) for key in self.counts}
+
+    def snapshot(self) -> List[Tuple[str, int, Optional[str]]]:
+        return [
+            (key, count, self.values.get(key))
+            for key, count in self.counts.items()
+        ]
+
+    def restore(self, snapshot: List[Tuple[str, int, Optional[str]]]):
+        # Snapshots saved before values were kept only have key and count
+        for key, count, *value in snapshot:
+            self.counts[key] = self.counts.get(key, 0) + count
+            if value:
+                self.values.setdefault(key, value[0])
+        for key, _ in self.top(len(self.counts))[self.capacity:]:
+            del self.counts[key]
+            self.values.pop(key, None)
@@ -1,39 +1,201 @@
-from typing import List
+from typing import List, Optional
+from datetime import datetime
+import asyncio
 import logging
+import time
 
 from app.config import Config
 from app.connections import create_connection, create_producer
+from app.infrastructure.codecs import get_codec
 from app.infrastructure.repository import Repository
 from app.adapters.gateway import Gateway
 from app.entities.models import (
     ServiceModel,
+    ServiceCreateModel,
     ServiceUpdateModel,
-    ProductModel
+    ProductModel,
+    ProductSearchModel,
+    ExportFormat,
+    ServicePriceAdjustmentModel,
+    PriceAdjustmentResultModel
 )
 
-from app.errors import ElementNotFoundError, DBConnectionError
+from app import deadline, metrics
+from app.monitoring import LoopLagMonitor
+from app.profiling import (
+    PROFILES_PATH,
+    ProfileRegistry,
+    ProfilingMiddleware
+)
+from app.errors import (
+    ElementNotFoundError,
+    DBConnectionError,
+    InsertionError,
+    VersionConflictError,
+    DeadlineExceededError,
+    MessagingError
+)
 
 import uvicorn
-from fastapi.responses import JSONResponse
-from fastapi import FastAPI, HTTPException, status, Response
+from bson import ObjectId
+from fastapi.responses import (
+    JSONResponse,
+    PlainTextResponse,
+    StreamingResponse
+)
+from fastapi import (
+    Depends,
+    FastAPI,
+    Header,
+    HTTPException,
+    Query,
+    status,
+    Response
+)
 
 conf = Config()
 app = FastAPI()
+profiles = ProfileRegistry(
+    conf.profiling_token,
+    conf.profiling_interval_ms,
+    conf.profiling_max_per_minute,
+    conf.profiling_keep
+)
+app.add_middleware(ProfilingMiddleware, registry=profiles)
+loop_lag_monitor = LoopLagMonitor(
+    conf.loop_lag_interval_ms,
+    conf.loop_lag_threshold_ms,
+    conf.loop_lag_log_interval_s
+)
 log = logging.getLogger(__name__)
 nosql_connection = create_connection()
 messaging_conn = create_producer()
 gateway = Gateway(
     Repository(
         nosql_connection,
-        messaging_conn
+        messaging_conn,
+        codec=get_codec(conf.message_codec)
     )
 )
 
 
-@app.get("/api/v1/products", response_model=List[ProductModel])
+def request_deadline(default_ms: int):
+    """Time budget for the request, clients may ask for another one with
+    the X-Request-Timeout header (milliseconds)"""
+    async def start_deadline(
+        x_request_timeout: Optional[int] = Header(None, gt=0)
+    ):
+        timeout_ms = x_request_timeout or default_ms
+        deadline.start(min(timeout_ms, conf.max_deadline_ms))
+    return Depends(start_deadline)
+
+
+SEARCH_DEADLINE = [request_deadline(conf.search_deadline_ms)]
+DEFAULT_DEADLINE = [request_deadline(conf.default_deadline_ms)]
+BULK_DEADLINE = [request_deadline(conf.max_deadline_ms)]
+
+
+@app.on_event("startup")
+async def start_loop_lag_monitor():
+    loop_lag_monitor.start()
+
+
+@app.on_event("shutdown")
+async def stop_loop_lag_monitor():
+    loop_lag_monitor.stop()
+
+
+@app.on_event("startup")
+async def create_indexes():
+    try:
+        await gateway.repository.create_indexes()
+    except DBConnectionError as e:
+        log.error(f"Could not create indexes: {e}")
+
+
+async def refresh_popular_searches():
+    interval = conf.popular_refresh_interval_s
+    last_decay = time.monotonic()
+    # Pre-warm at once on startup, later rounds are spread over the
+    # interval so Syscom does not get every reload at the same time
+    spread = 0
+    while True:
+        started = time.monotonic()
+        # A round takes up to one interval, reload anything that would
+        # expire before the next one finishes
+        await gateway.refresh_popular_searches(
+            horizon=3 * interval,
+            spread=spread
+        )
+        spread = interval
+        if time.monotonic() - last_decay > conf.popular_decay_interval_s:
+            gateway.decay_query_stats()
+            last_decay = time.monotonic()
+        try:
+            await gateway.save_query_stats()
+        except InsertionError as e:
+            log.error(f"Could not save query stats: {e}")
+        await asyncio.sleep(max(interval - (time.monotonic() - started), 0))
+
+
+@app.on_event("startup")
+async def start_cache_warming():
+    try:
+        await gateway.restore_query_stats()
+    except DBConnectionError as e:
+        log.error(f"Could not restore query stats: {e}")
+    app.state.cache_warming = asyncio.create_task(refresh_popular_searches())
+
+
+@app.on_event("shutdown")
+async def stop_cache_warming():
+    app.state.cache_warming.cancel()
+    try:
+        await gateway.save_query_stats()
+    except InsertionError as e:
+        log.error(f"Could not save query stats: {e}")
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    return metrics.render()
+
+
+@app.get(
+        PROFILES_PATH + "/{profile_id}",
+        response_class=PlainTextResponse)
+async def get_profile(
+    profile_id: str,
+    x_profile_token: Optional[str] = Header(None)
+):
+    token = x_profile_token.encode("utf-8") if x_profile_token else None
+    if not profiles.is_authorized(token):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Not allowed to read profiles"
+        )
+    profile = profiles.get(profile_id)
+    if profile is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Profile not found"
+        )
+    return profile
+
+
+@app.get(
+        "/api/v1/products",
+        response_model=List[ProductSearchModel],
+        dependencies=SEARCH_DEADLINE)
 async def search_product(product_name: str):
     try:
         products = await gateway.search_product(product_name)
+    except DeadlineExceededError as e:
+        log.error(f"Request deadline exceeded: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+            detail="Request took too long"
+        )
     except (ElementNotFoundError, DBConnectionError) as e:
         log.error(f"Could not get data from third party endpoint: {e}")
         raise HTTPException(
@@ -46,13 +208,23 @@ async def search_product(product_name: str):
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Could not search the product"
         )
-    return products
+    # Types are already coerced by the mapping plan, skip re-validating
+    return JSONResponse(content=[product.to_dict() for product in products])
 
 
-@app.get("/api/v1/services", response_model=List[ServiceModel])
+@app.get(
+        "/api/v1/services",
+        response_model=List[ServiceModel],
+        dependencies=DEFAULT_DEADLINE)
 async def search_service_by_name(service_name: str):
     try:
         services = await gateway.search_services_by_name(service_name)
+    except DeadlineExceededError as e:
+        log.error(f"Request deadline exceeded: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+            detail="Request took too long"
+        )
     except (ElementNotFoundError, DBConnectionError) as e:
         log.error(f"Could not find the service: {e}")
         raise HTTPException(
@@ -68,12 +240,21 @@ async def search_service_by_name(service_name: str):
     return services
 
 
-@app.get("/api/v1/services/description", response_model=List[ServiceModel])
+@app.get(
+        "/api/v1/services/description",
+        response_model=List[ServiceModel],
+        dependencies=DEFAULT_DEADLINE)
 async def search_service_by_description(service_description: str):
     try:
         services = await gateway.search_services_by_description(
             service_description
         )
+    except DeadlineExceededError as e:
+        log.error(f"Request deadline exceeded: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+            detail="Request took too long"
+        )
     except (ElementNotFoundError, DBConnectionError) as e:
         log.error(f"Could not find the service: {e}")
         raise HTTPException(
@@ -89,10 +270,91 @@ async def search_service_by_description(service_description: str):
     return services
 
 
-@app.get("/api/v1/services/{service_id}", response_model=ServiceModel)
-async def get_service(service_id: str):
+@app.get(
+        "/api/v1/services/autocomplete",
+        response_model=List[ServiceModel],
+        dependencies=DEFAULT_DEADLINE)
+async def autocomplete_services(
+    prefix: str = Query(..., min_length=1),
+    limit: int = Query(10, gt=0)
+):
+    try:
+        services = await gateway.autocomplete_services(prefix, limit)
+    except DeadlineExceededError as e:
+        log.error(f"Request deadline exceeded: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+            detail="Request took too long"
+        )
+    except (ElementNotFoundError, DBConnectionError) as e:
+        log.error(f"Could not find the service: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Could not find the service"
+        )
+    except Exception as e:
+        log.error(f"Could not find the service: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Could not search the service"
+        )
+    return services
+
+
+def _export_response(chunks, name: str, export_format: ExportFormat):
+    return StreamingResponse(
+        chunks,
+        media_type="application/gzip",
+        headers={
+            "Content-Disposition":
+                f"attachment; filename={name}.{export_format.value}.gz"
+        }
+    )
+
+
+@app.get("/api/v1/services/export")
+async def export_services(
+    export_format: ExportFormat = ExportFormat.ndjson,
+    since_id: Optional[str] = None,
+    since: Optional[datetime] = None
+):
+    if since_id is not None and not ObjectId.is_valid(since_id):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="since_id is not a valid id"
+        )
+    chunks = gateway.export_services(export_format, since_id, since)
+    return _export_response(chunks, "services", export_format)
+
+
+@app.get("/api/v1/products/export")
+async def export_products(
+    export_format: ExportFormat = ExportFormat.ndjson,
+    since_id: Optional[str] = None,
+    since: Optional[datetime] = None
+):
+    if since_id is not None and not ObjectId.is_valid(since_id):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="since_id is not a valid id"
+        )
+    chunks = gateway.export_products(export_format, since_id, since)
+    return _export_response(chunks, "products", export_format)
+
+
+@app.get(
+        "/api/v1/services/{service_id}",
+        response_model=ServiceModel,
+        dependencies=DEFAULT_DEADLINE)
+async def get_service(service_id: str, response: Response):
     try:
         service = await gateway.get_service(service_id)
+    except DeadlineExceededError as e:
+        log.error(f"Request deadline exceeded: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+            detail="Request took too long"
+        )
     except (ElementNotFoundError, DBConnectionError) as e:
         log.error(f"Could not find the service: {e}")
         raise HTTPException(
@@ -105,13 +367,56 @@ async def get_service(service_id: str):
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Could not find the service"
         )
+    response.headers["ETag"] = f'"{service.get("version", 0)}"'
     return service
 
 
-@app.get("/api/v1/products/{product_id}", response_model=ProductModel)
+@app.get(
+        "/api/v1/products/batch",
+        response_model=List[ProductModel],
+        dependencies=SEARCH_DEADLINE)
+async def get_products(ids: List[str] = Query(...)):
+    if len(ids) > conf.max_search_elements:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Ask for at most {conf.max_search_elements} products"
+        )
+    try:
+        products = await gateway.get_products(ids)
+    except DeadlineExceededError as e:
+        log.error(f"Request deadline exceeded: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+            detail="Request took too long"
+        )
+    except (ElementNotFoundError, DBConnectionError) as e:
+        log.error(f"Could not find the products: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Could not find the products"
+        )
+    except Exception as e:
+        log.error(f"Could not find the products: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Could not find the products"
+        )
+    return products
+
+
+@app.get(
+        "/api/v1/products/{product_id}",
+        response_model=ProductModel,
+        dependencies=SEARCH_DEADLINE)
 async def get_product(product_id: str):
     try:
         product = await gateway.get_product(product_id)
+    except DeadlineExceededError as e:
+        log.error(f"Request deadline exceeded: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+            detail="Request took too long"
+        )
     except (ElementNotFoundError, DBConnectionError) as e:
         log.error(f"Could not find the product: {e}")
         raise HTTPException(
@@ -130,10 +435,25 @@ async def get_product(product_id: str):
 @app.post(
         "/api/v1/services",
         response_description="Add new service",
-        response_model=ServiceModel)
-async def create_service(service: ServiceModel):
+        response_model=ServiceModel,
+        dependencies=DEFAULT_DEADLINE)
+async def create_service(service: ServiceCreateModel):
     try:
-        service = await gateway.create_service(service)
+        service = await gateway.create_service(
+            ServiceModel(**service.dict())
+        )
+    except DeadlineExceededError as e:
+        log.error(f"Request deadline exceeded: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+            detail="Request took too long"
+        )
+    except MessagingError as e:
+        log.error(f"Could not publish the change: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many pending changes, try again later"
+        )
     except (ElementNotFoundError, DBConnectionError) as e:
         log.error(f"Could not create the service: {e}")
         raise HTTPException(
@@ -155,10 +475,23 @@ async def create_service(service: ServiceModel):
 @app.post(
         "/api/v1/products",
         response_description="Add new service",
-        response_model=ProductModel)
+        response_model=ProductModel,
+        dependencies=DEFAULT_DEADLINE)
 async def create_product(product: ProductModel):
     try:
         product = await gateway.create_product(product)
+    except DeadlineExceededError as e:
+        log.error(f"Request deadline exceeded: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+            detail="Request took too long"
+        )
+    except MessagingError as e:
+        log.error(f"Could not publish the change: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many pending changes, try again later"
+        )
     except (ElementNotFoundError, DBConnectionError) as e:
         log.error(f"Could not create the product: {e}")
         raise HTTPException(
@@ -177,10 +510,81 @@ async def create_product(product: ProductModel):
     )
 
 
-@app.patch("/api/v1/services/{service_id}")
-async def modify_service(service_id: str, service: ServiceUpdateModel):
+@app.post(
+        "/api/v1/services/price-adjustments",
+        response_model=PriceAdjustmentResultModel,
+        dependencies=BULK_DEADLINE)
+async def adjust_service_prices(adjustment: ServicePriceAdjustmentModel):
+    try:
+        result = await gateway.adjust_service_prices(adjustment)
+    except DeadlineExceededError as e:
+        log.error(f"Request deadline exceeded: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+            detail="Request took too long"
+        )
+    except MessagingError as e:
+        log.error(f"Could not publish the change: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many pending changes, try again later"
+        )
+    except (ElementNotFoundError, DBConnectionError) as e:
+        log.error(f"Could not adjust service prices: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Could not adjust service prices"
+        )
+    except Exception as e:
+        log.error(f"Could not adjust service prices: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Could not adjust service prices"
+        )
+    return result
+
+
+@app.patch(
+        "/api/v1/services/{service_id}",
+        dependencies=DEFAULT_DEADLINE)
+async def modify_service(
+    service_id: str,
+    service: ServiceUpdateModel,
+    if_match: Optional[str] = Header(None)
+):
+    expected_version = None
+    if if_match is not None:
+        try:
+            expected_version = int(if_match.strip('W/"'))
+        except ValueError:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="If-Match must be the service version"
+            )
     try:
-        service = await gateway.modify_service(service_id, service)
+        service = await gateway.modify_service(
+            service_id,
+            service,
+            expected_version
+        )
+    except VersionConflictError as e:
+        log.error(f"Could not update the service: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Service was modified by someone else"
+        )
+    except DeadlineExceededError as e:
+        log.error(f"Request deadline exceeded: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+            detail="Request took too long"
+        )
+    except MessagingError as e:
+        log.error(f"Could not publish the change: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many pending changes, try again later"
+        )
     except (ElementNotFoundError, DBConnectionError) as e:
         log.error(f"Could not update the service: {e}")
         raise HTTPException(
@@ -193,7 +597,10 @@ async def modify_service(service_id: str, service: ServiceUpdateModel):
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Could not update the service"
         )
-    return Response(status_code=status.HTTP_204_NO_CONTENT)
+    return Response(
+        status_code=status.HTTP_204_NO_CONTENT,
+        headers={"ETag": f'"{service.get("version", 0)}"'}
+    )
 
 
 if __name__ == "__main__":
@@ -1,4 +1,8 @@
-from pydantic import BaseSettings
+from typing import Optional
+
+from pydantic import BaseSettings, root_validator, validator
+
+MIN_MAX_STALENESS_S = 90
 
 
 class Config(BaseSettings):
@@ -18,3 +22,62 @@ class Config(BaseSettings):
     sasl_pass: str
     max_search_elements: int
     kafka_topic: str
+    export_batch_size: int = 500
+    export_compress_level: int = 6
+    message_codec: str = "json"
+    kafka_compression: str = "lz4"
+    kafka_linger_ms: int = 5
+    kafka_queue_full_timeout_ms: int = 5000
+    kafka_flush_timeout_ms: int = 10000
+    default_deadline_ms: int = 5000
+    search_deadline_ms: int = 10000
+    max_deadline_ms: int = 30000
+    syscom_timeout_ms: int = 10000
+    profiling_token: Optional[str] = None
+    profiling_interval_ms: int = 5
+    profiling_max_per_minute: int = 6
+    profiling_keep: int = 20
+    search_cache_size: int = 1024
+    product_search_cache_ttl_s: int = 300
+    service_search_cache_ttl_s: int = 30
+    popular_queries_capacity: int = 256
+    popular_queries_top_k: int = 20
+    popular_refresh_interval_s: int = 10
+    popular_decay_interval_s: int = 3600
+    query_stats_collec: str = "query_stats"
+    mongo_max_pool_size: int = 100
+    mongo_min_pool_size: int = 0
+    search_read_preference: str = "secondaryPreferred"
+    search_max_staleness_s: int = 90
+    search_read_concern: Optional[str] = None
+    entity_read_preference: str = "primary"
+    entity_read_concern: Optional[str] = None
+    causal_consistency: bool = False
+    loop_lag_interval_ms: int = 100
+    loop_lag_threshold_ms: int = 200
+    loop_lag_log_interval_s: int = 60
+    notify_batch_size: int = 500
+
+    @root_validator(skip_on_failure=True)
+    def check_popular_refresh(cls, values):
+        # The warmer reloads a popular search at most two intervals after
+        # its previous reload, a shorter TTL lets it expire in between
+        min_ttl = 2 * values["popular_refresh_interval_s"]
+        for ttl in ("product_search_cache_ttl_s",
+                    "service_search_cache_ttl_s"):
+            if values[ttl] <= min_ttl:
+                raise ValueError(
+                    f"{ttl} must be longer than twice "
+                    "popular_refresh_interval_s"
+                )
+        return values
+
+    @validator("search_max_staleness_s")
+    def check_max_staleness(cls, value):
+        # The server does not accept bounds under 90 seconds
+        if value != -1 and value < MIN_MAX_STALENESS_S:
+            raise ValueError(
+                f"search_max_staleness_s must be -1 or at least "
+                f"{MIN_MAX_STALENESS_S}"
+            )
+        return value
@@ -16,7 +16,11 @@ def create_connection() -> AsyncIOMotorDatabase:
     url_connection = conf.mongodb_url
     database_name = conf.mongo_db
     try:
-        client = AsyncIOMotorClient(url_connection)
+        client = AsyncIOMotorClient(
+            url_connection,
+            maxPoolSize=conf.mongo_max_pool_size,
+            minPoolSize=conf.mongo_min_pool_size
+        )
     except (ConfigurationError, ConnectionFailure) as e:
         raise DBConnectionError(
             f"Could not connect to database due to: {e}"
@@ -32,5 +36,7 @@ def create_producer() -> Producer:
         "sasl.mechanisms": conf.sasl_mechanism,
         "sasl.username": conf.sasl_username,
         "sasl.password": conf.sasl_pass,
+        "compression.type": conf.kafka_compression,
+        "linger.ms": conf.kafka_linger_ms,
     }
     return Producer(kafka_conf)
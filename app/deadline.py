@@ -0,0 +1,46 @@
+import time
+from contextvars import ContextVar
+from typing import Optional
+
+from app.errors import DeadlineExceededError
+from app.metrics import Counter
+
+
+_deadline: ContextVar[Optional[float]] = ContextVar("deadline", default=None)
+
+deadline_exceeded = Counter(
+    "deadline_exceeded_total",
+    "Requests that ran out of time budget, by layer"
+)
+
+
+def start(timeout_ms: int):
+    """Give the current request timeout_ms milliseconds from now"""
+    _deadline.set(time.monotonic() + timeout_ms / 1000)
+
+
+def exceeded(layer: str) -> DeadlineExceededError:
+    deadline_exceeded.inc(layer=layer)
+    return DeadlineExceededError(f"Request deadline exceeded in {layer}")
+
+
+def remaining(layer: str) -> Optional[float]:
+    """Seconds left for the current request, None when it has no deadline
+
+    Raises:
+        DeadlineExceededError: when the budget is already spent
+    """
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    left = deadline - time.monotonic()
+    if left <= 0:
+        raise exceeded(layer)
+    return left
+
+
+def remaining_ms(layer: str) -> Optional[int]:
+    left = remaining(layer)
+    if left is None:
+        return None
+    return max(int(left * 1000), 1)
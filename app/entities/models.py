@@ -1,7 +1,7 @@
 from enum import Enum
-from typing import Optional, TypedDict, Union
+from typing import Dict, List, Optional, Tuple, TypedDict, Union
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, root_validator, validator
 from bson import ObjectId
 
 
@@ -21,7 +21,7 @@ class PyObjectId(ObjectId):
         field_schema.update(type="string")
 
 
-class ServiceModel(BaseModel):
+class ServiceCreateModel(BaseModel):
     id: PyObjectId = Field(default_factory=PyObjectId, alias="_id")
     name: str = Field(...)
     description: str = Field(...)
@@ -42,6 +42,10 @@ class ServiceModel(BaseModel):
         }
 
 
+class ServiceModel(ServiceCreateModel):
+    version: int = 0
+
+
 class ServiceUpdateModel(BaseModel):
     name: Optional[str]
     description: Optional[str]
@@ -67,6 +71,94 @@ class ServiceDictModel(TypedDict):
     description: str
     client_price: float
     real_price: float
+    version: int
+
+
+class ServiceDeltaModel(BaseModel):
+    id: str = Field(..., alias="_id")
+    changes: dict
+    expected_version: Optional[int]
+
+    class Config:
+        allow_population_by_field_name = True
+
+
+class PriceOperation(Enum):
+    percentage = "percentage"
+    fixed = "fixed"
+    margin = "margin"
+
+
+class ServicePrice(Enum):
+    client_price = "client_price"
+    real_price = "real_price"
+
+
+class ServicePriceAdjustmentModel(BaseModel):
+    ids: Optional[List[str]]
+    name: Optional[str]
+    description: Optional[str]
+    operation: PriceOperation
+    value: float
+    prices: List[ServicePrice] = [ServicePrice.client_price]
+    dry_run: bool = False
+
+    class Config:
+        schema_extra = {
+            "example": {
+                "name": "Mantenimiento",
+                "operation": "percentage",
+                "value": 8.5,
+                "prices": ["client_price", "real_price"],
+                "dry_run": True
+            }
+        }
+
+    @root_validator(skip_on_failure=True)
+    def check_filter(cls, values):
+        if not (values.get("ids") or values.get("name")
+                or values.get("description")):
+            raise ValueError("Filter services by ids, name or description")
+        return values
+
+    @validator("value")
+    def check_value(cls, value, values):
+        # A fixed amount can only be checked per service, it is floored at 0
+        operation = values.get("operation")
+        if operation == PriceOperation.percentage and value <= -100:
+            raise ValueError("Value must be greater than -100 percent")
+        if operation == PriceOperation.margin and value >= 100:
+            raise ValueError("Margin must be lower than 100 percent")
+        return value
+
+    def formulas(self) -> Dict[str, Tuple[str, float, float]]:
+        """How each adjusted price is computed, as (source price, factor,
+        addend): new price = round(max(source * factor + addend, 0), 2).
+        Percentage and fixed change the chosen prices, margin sets
+        client_price so that value percent of it is over real_price
+        """
+        if self.operation == PriceOperation.margin:
+            factor = 1 / (1 - self.value / 100)
+            return {"client_price": ("real_price", factor, 0)}
+        if self.operation == PriceOperation.percentage:
+            factor = 1 + self.value / 100
+            return {price.value: (price.value, factor, 0)
+                    for price in self.prices}
+        return {price.value: (price.value, 1, self.value)
+                for price in self.prices}
+
+    def apply(self, service: dict) -> dict:
+        """New prices of a service, see formulas"""
+        return {
+            price: round(max(service[source] * factor + addend, 0), 2)
+            for price, (source, factor, addend) in self.formulas().items()
+        }
+
+
+class PriceAdjustmentResultModel(BaseModel):
+    matched: int
+    modified: int
+    dry_run: bool
 
 
 class ProductModel(BaseModel):
@@ -102,6 +194,77 @@ class ProducDictModel(BaseModel):
     weight: float
 
 
+class ProductSearchModel(BaseModel):
+    """Catalog search result, it gets an id once it is stored"""
+    title: Optional[str]
+    list_price: Optional[float]
+    discount_price: Optional[float]
+    image: Optional[str]
+    stock_number: Optional[int]
+    brand: Optional[str]
+    product_id: Optional[int]
+    model: Optional[str]
+    sat_key: Optional[int]
+    weight: Optional[float]
+
+
+def catalog_product_id(product_id: int) -> ObjectId:
+    """ObjectId of a catalog product, derived from its product_id so every
+    fetch of the same product builds the same document"""
+    return ObjectId(f"{int(product_id):024x}")
+
+
+class ProductSearchItem:
+    """Unvalidated product from a catalog search. ProductModel, along with
+    its ObjectId, is only built when the product is going to be stored"""
+
+    __slots__ = (
+        "title",
+        "list_price",
+        "discount_price",
+        "image",
+        "stock_number",
+        "brand",
+        "product_id",
+        "model",
+        "sat_key",
+        "weight",
+    )
+
+    def __init__(
+        self,
+        title,
+        list_price,
+        discount_price,
+        image,
+        stock_number,
+        brand,
+        product_id,
+        model,
+        sat_key,
+        weight
+    ):
+        self.title = title
+        self.list_price = list_price
+        self.discount_price = discount_price
+        self.image = image
+        self.stock_number = stock_number
+        self.brand = brand
+        self.product_id = product_id
+        self.model = model
+        self.sat_key = sat_key
+        self.weight = weight
+
+    def to_dict(self) -> dict:
+        return {field: getattr(self, field) for field in self.__slots__}
+
+    def to_model(self) -> ProductModel:
+        return ProductModel(
+            id=catalog_product_id(self.product_id),
+            **self.to_dict()
+        )
+
+
 class ExistenceModel(TypedDict):
     nuevo: int
     asterisco: dict
@@ -142,8 +305,14 @@ class ProductResponseSearchModel(TypedDict):
 class MessageType(Enum):
     service = "Service"
     product = "Product"
+    service_update = "ServiceUpdate"
+
+
+class ExportFormat(Enum):
+    ndjson = "ndjson"
+    csv = "csv"
 
 
 class MessageFormat(BaseModel):
     type: str
-    content: Union[ServiceModel, ProductModel]
+    content: Union[ServiceModel, ProductModel, ServiceDeltaModel]
@@ -12,3 +12,15 @@ class ElementNotFoundError(Exception):
 
 class InsertionError(Exception):
     """When there was a problem while inserting a DB"""
+
+
+class VersionConflictError(Exception):
+    """When the element was modified since the version the client read"""
+
+
+class DeadlineExceededError(Exception):
+    """When the request ran out of time before finishing"""
+
+
+class MessagingError(Exception):
+    """When a message could not be queued for the broker"""
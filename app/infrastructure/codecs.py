@@ -0,0 +1,80 @@
+import json
+from abc import ABC, abstractmethod
+from typing import Dict, List, Tuple, Type
+
+from app.entities.models import MessageFormat
+
+import msgpack
+
+
+SCHEMA_VERSION = 1
+SCHEMA_VERSION_HEADER = "schema-version"
+CONTENT_TYPE_HEADER = "content-type"
+
+
+class MessageCodec(ABC):
+
+    content_type: str
+
+    @abstractmethod
+    def encode(self, message: MessageFormat) -> bytes:
+        """Serialize a change message
+
+        Args:
+            message (MessageFormat): message to send
+
+        Returns:
+            bytes: message payload
+        """
+
+    @abstractmethod
+    def decode(self, payload: bytes) -> dict:
+        """Deserialize a change message
+
+        Args:
+            payload (bytes): message payload
+
+        Returns:
+            dict: message type and content
+        """
+
+    def headers(self) -> List[Tuple[str, bytes]]:
+        return [
+            (SCHEMA_VERSION_HEADER, str(SCHEMA_VERSION).encode("utf-8")),
+            (CONTENT_TYPE_HEADER, self.content_type.encode("utf-8")),
+        ]
+
+
+class JSONCodec(MessageCodec):
+
+    content_type = "application/json"
+
+    def encode(self, message: MessageFormat) -> bytes:
+        return message.json(encoder=str).encode("utf-8")
+
+    def decode(self, payload: bytes) -> dict:
+        return json.loads(payload)
+
+
+class MsgPackCodec(MessageCodec):
+
+    content_type = "application/msgpack"
+
+    def encode(self, message: MessageFormat) -> bytes:
+        return msgpack.packb(message.dict(), default=str, use_bin_type=True)
+
+    def decode(self, payload: bytes) -> dict:
+        return msgpack.unpackb(payload, raw=False)
+
+
+CODECS: Dict[str, Type[MessageCodec]] = {
+    "json": JSONCodec,
+    "msgpack": MsgPackCodec,
+}
+
+
+def get_codec(name: str) -> MessageCodec:
+    try:
+        return CODECS[name]()
+    except KeyError:
+        raise ValueError(f"Unknown message codec: {name}")
@@ -0,0 +1,9 @@
+import unicodedata
+
+
+def normalize_text(text: str) -> str:
+    """Lowercase text without accents, "Instalación" -> "instalacion" """
+    decomposed = unicodedata.normalize("NFKD", text or "")
+    return "".join(
+        char for char in decomposed if not unicodedata.combining(char)
+    ).casefold()
@@ -1,17 +1,25 @@
+import time
 import logging
-from typing import List, Union
+from datetime import datetime
+from contextlib import asynccontextmanager
 from dataclasses import dataclass
+from typing import AsyncIterator, Dict, List, Optional, Tuple, Union
 
+from app import deadline
+from app.profiling import to_thread
 from app.config import Config
 from app.errors import (
     ElementNotFoundError,
     TokenError,
     InsertionError,
-    DBConnectionError
+    DBConnectionError,
+    MessagingError,
+    VersionConflictError
 )
 from app.entities.models import (
     ServiceModel,
     ServiceUpdateModel,
+    ServicePriceAdjustmentModel,
     ProductResponseSearchModel,
     ProductModel,
     ProducDictModel,
@@ -19,21 +27,45 @@ from app.entities.models import (
     MessageFormat,
     MessageType
 )
+from app.infrastructure.codecs import MessageCodec, JSONCodec
+from app.infrastructure.normalization import normalize_text
 from app.infrastructure.repository_i import RepositoryInterface
 
 import requests
+from bson import ObjectId
+from pymongo import ASCENDING, ReturnDocument
 from pydantic import BaseSettings
 from confluent_kafka import Producer
+from pymongo.read_concern import ReadConcern
 from fastapi.encoders import jsonable_encoder
-from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo.read_preferences import (
+    make_read_preference,
+    read_pref_mode_from_name
+)
+from motor.motor_asyncio import (
+    AsyncIOMotorClientSession,
+    AsyncIOMotorCollection,
+    AsyncIOMotorDatabase
+)
 from pymongo.errors import (
     ConnectionFailure,
-    ExecutionTimeout
+    DuplicateKeyError,
+    ExecutionTimeout,
+    OperationFailure
 )
 
 
 log = logging.getLogger(__name__)
 EMPTY_COUNT = 0
+INDEX_OPTIONS_CONFLICT = 85
+MONGO_LAYER = "mongo"
+NAME_NORMALIZED = "name_normalized"
+PREFIX_UPPER_BOUND = "\uffff"
+QUERY_STATS_ID = "popular_queries"
+SEARCH_READS = "search"
+ENTITY_READS = "entity"
+SYSCOM_LAYER = "syscom"
+UPDATED_AT = "updated_at"
 
 
 @dataclass
@@ -42,36 +74,134 @@ class Repository(RepositoryInterface):
     nosql_conn: AsyncIOMotorDatabase
     messaging_con: Producer
     config: BaseSettings = Config()
+    codec: MessageCodec = JSONCodec()
+
+    def __post_init__(self):
+        self.read_settings = {
+            SEARCH_READS: self._read_settings(
+                self.config.search_read_preference,
+                self.config.search_max_staleness_s,
+                self.config.search_read_concern
+            ),
+            ENTITY_READS: self._read_settings(
+                self.config.entity_read_preference,
+                -1,
+                self.config.entity_read_concern
+            ),
+        }
+        self.cluster_time: Optional[dict] = None
+        self.operation_time = None
 
     async def get_service_data(self, service_id: int) -> ServiceDictModel:
+        services = self._reads(self.config.services_collec, ENTITY_READS)
         try:
-            service = await self.nosql_conn[self.config.services_collec].find_one(  # noqa
-                {"_id": service_id}
-            )
-        except (ConnectionFailure, ExecutionTimeout):
+            async with self._session() as session:
+                service = await services.find_one(
+                    {"_id": service_id},
+                    max_time_ms=deadline.remaining_ms(MONGO_LAYER),
+                    session=session
+                )
+        except ExecutionTimeout:
+            raise deadline.exceeded(MONGO_LAYER)
+        except ConnectionFailure:
             raise DBConnectionError(
                 "Service not found in DB"
             )
-        if service.__len__() == EMPTY_COUNT:
+        if not service:
             raise ElementNotFoundError(
                 "Service not found in DB"
             )
         return service
 
-    async def get_product_data(self, product_id: int) -> ProducDictModel:
+    async def get_service_version(self, service_id: str) -> int:
+        services = self._reads(self.config.services_collec, ENTITY_READS)
         try:
-            product = await self.nosql_conn[self.config.products_collec].find_one(  # noqa
-                {"_id": product_id}
+            async with self._session() as session:
+                service = await services.find_one(
+                    {"_id": service_id},
+                    {"version": True},
+                    max_time_ms=deadline.remaining_ms(MONGO_LAYER),
+                    session=session
+                )
+        except ExecutionTimeout:
+            raise deadline.exceeded(MONGO_LAYER)
+        except ConnectionFailure:
+            raise DBConnectionError(
+                "Service not found in DB"
             )
-        except (DBConnectionError, ExecutionTimeout):
+        if not service:
             raise ElementNotFoundError(
+                "Service not found in DB"
+            )
+        # Services stored before versioning have no field, take them
+        # as version 0
+        return service.get("version", EMPTY_COUNT)
+
+    async def get_product_data(self, product_id: str) -> ProducDictModel:
+        products = self._reads(self.config.products_collec, ENTITY_READS)
+        try:
+            async with self._session() as session:
+                product = await products.find_one(
+                    self._product_query([product_id]),
+                    max_time_ms=deadline.remaining_ms(MONGO_LAYER),
+                    session=session
+                )
+        except ExecutionTimeout:
+            raise deadline.exceeded(MONGO_LAYER)
+        except ConnectionFailure:
+            raise DBConnectionError(
                 "Product not found in DB"
             )
-        if product.__len__() == EMPTY_COUNT:
+        if not product:
             raise ElementNotFoundError(
                 "Product not found in DB"
             )
-        return product[0]
+        return product
+
+    async def get_products_data(
+        self,
+        product_ids: List[str]
+    ) -> List[ProducDictModel]:
+        collection = self._reads(self.config.products_collec, ENTITY_READS)
+        try:
+            async with self._session() as session:
+                products = await collection.find(
+                    self._product_query(product_ids),
+                    max_time_ms=deadline.remaining_ms(MONGO_LAYER),
+                    session=session
+                ).to_list(len(product_ids))
+        except ExecutionTimeout:
+            raise deadline.exceeded(MONGO_LAYER)
+        except ConnectionFailure:
+            raise DBConnectionError(
+                "Could not found products in DB"
+            )
+        return products
+
+    async def fetch_product(
+        self,
+        product_id: str
+    ) -> ProductResponseSearchModel:
+        token = await self._get_token()
+        URL = f"{self.config.syscom_api_url}productos/{product_id}"
+        autorization_header = {
+            "Authorization": f"Bearer {token}"
+        }
+        timeout = self._syscom_timeout()
+        try:
+            response = await self._syscom_request(
+                "GET",
+                URL,
+                timeout,
+                headers=autorization_header
+            )
+            response.raise_for_status()
+        except requests.Timeout:
+            raise deadline.exceeded(SYSCOM_LAYER)
+        except (requests.ConnectionError, requests.HTTPError) as e:
+            log.error(f"Could not get data from third party endpoint: {e}")
+            raise ElementNotFoundError("Could not get product data")
+        return response.json()
 
     async def search_products(
         self,
@@ -82,13 +212,18 @@ class Repository(RepositoryInterface):
         autorization_header = {
             "Authorization": f"Bearer {token}"
         }
+        timeout = self._syscom_timeout()
         try:
-            response = requests.get(URL, headers=autorization_header)
+            response = await self._syscom_request(
+                "GET",
+                URL,
+                timeout,
+                headers=autorization_header
+            )
             response.raise_for_status()
-        except (
-            requests.ConnectionError,
-            requests.exceptions.ConnectTimeout
-        ) as e:
+        except requests.Timeout:
+            raise deadline.exceeded(SYSCOM_LAYER)
+        except requests.ConnectionError as e:
             log.error(f"Could not get data from third party endpoint: {e}")
             raise ElementNotFoundError("Could not get product search data")
         raw_data = response.json()
@@ -98,16 +233,20 @@ class Repository(RepositoryInterface):
         self,
         service_name: str
     ) -> List[ServiceDictModel]:
+        services = self._reads(self.config.services_collec, SEARCH_READS)
         try:
-            services_get = await self.nosql_conn[self.config.services_collec].find(  # noqa
+            services_get = await services.find(
                 {
                     "name": {
                         "$regex": service_name,
                         "$options": "mxsi"
                     }
-                }
+                },
+                max_time_ms=deadline.remaining_ms(MONGO_LAYER)
             ).to_list(self.config.max_search_elements)
-        except (ConnectionFailure, ExecutionTimeout):
+        except ExecutionTimeout:
+            raise deadline.exceeded(MONGO_LAYER)
+        except ConnectionFailure:
             raise DBConnectionError(
                 "Could not found service in DB"
             )
@@ -117,37 +256,131 @@ class Repository(RepositoryInterface):
         self,
         service_description: str
     ) -> List[ServiceDictModel]:
+        services = self._reads(self.config.services_collec, SEARCH_READS)
         try:
-            services_get = await self.nosql_conn[self.config.services_collec].find(  # noqa
+            services_get = await services.find(
                 {
                     "description": {
                         "$regex": service_description,
                         "$options": "mxsi"
                     }
-                }
+                },
+                max_time_ms=deadline.remaining_ms(MONGO_LAYER)
             ).to_list(self.config.max_search_elements)
-        except (ConnectionFailure, ExecutionTimeout):
+        except ExecutionTimeout:
+            raise deadline.exceeded(MONGO_LAYER)
+        except ConnectionFailure:
             raise DBConnectionError(
                 "Could not found service in DB"
             )
         return services_get
 
+    async def autocomplete_services(
+        self,
+        prefix: str,
+        limit: int
+    ) -> List[ServiceDictModel]:
+        normalized_prefix = normalize_text(prefix)
+        limit = min(limit, self.config.max_search_elements)
+        services = self._reads(self.config.services_collec, SEARCH_READS)
+        try:
+            services_get = await services.find(
+                {
+                    NAME_NORMALIZED: {
+                        "$gte": normalized_prefix,
+                        "$lt": normalized_prefix + PREFIX_UPPER_BOUND
+                    }
+                },
+                {NAME_NORMALIZED: False},
+                max_time_ms=deadline.remaining_ms(MONGO_LAYER)
+            ).sort(NAME_NORMALIZED, ASCENDING).limit(limit).to_list(limit)
+        except ExecutionTimeout:
+            raise deadline.exceeded(MONGO_LAYER)
+        except ConnectionFailure:
+            raise DBConnectionError(
+                "Could not found service in DB"
+            )
+        return services_get
+
+    async def create_indexes(self):
+        try:
+            await self.nosql_conn[self.config.services_collec].create_index(
+                [(NAME_NORMALIZED, ASCENDING)]
+            )
+            for collection in (self.config.services_collec,
+                               self.config.products_collec):
+                await self.nosql_conn[collection].create_index(
+                    [(UPDATED_AT, ASCENDING)]
+                )
+            await self._create_product_id_index()
+        except DuplicateKeyError:
+            raise DBConnectionError(
+                "Products are duplicated by product_id, remove them so the "
+                "index can be unique"
+            )
+        except ConnectionFailure:
+            raise DBConnectionError("Could not create services indexes")
+
+    async def _create_product_id_index(self):
+        # Unique, so replicas fetching the same product store it only once
+        products = self.nosql_conn[self.config.products_collec]
+        keys = [("product_id", ASCENDING)]
+        try:
+            await products.create_index(keys, unique=True)
+        except OperationFailure as e:
+            if e.code != INDEX_OPTIONS_CONFLICT:
+                raise
+            # Replace the non unique index created by earlier versions
+            await products.drop_index(keys)
+            await products.create_index(keys, unique=True)
+
     async def create_service(self, service: ServiceModel) -> ServiceDictModel:
         service = jsonable_encoder(service)
+        deadline.remaining(MONGO_LAYER)
         try:
-            await self.nosql_conn[self.config.services_collec].insert_one(
-                service
-            )
+            async with self._session() as session:
+                await self.nosql_conn[self.config.services_collec].insert_one(
+                    {
+                        **service,
+                        NAME_NORMALIZED: normalize_text(service["name"]),
+                        UPDATED_AT: datetime.utcnow()
+                    },
+                    session=session
+                )
         except (ConnectionFailure, ExecutionTimeout):
             raise InsertionError("Could not insert service in DB")
         return service
 
+    async def save_product(self, product: ProductModel) -> ProducDictModel:
+        """Store a catalog product unless it was already stored"""
+        product = jsonable_encoder(product)
+        try:
+            async with self._session() as session:
+                await self.nosql_conn[self.config.products_collec].update_one(
+                    {"product_id": product["product_id"]},
+                    {"$setOnInsert": {
+                        **product,
+                        UPDATED_AT: datetime.utcnow()
+                    }},
+                    upsert=True,
+                    session=session
+                )
+        except DuplicateKeyError:
+            # Another replica stored it between the lookup and the insert
+            pass
+        except (ConnectionFailure, ExecutionTimeout):
+            raise InsertionError("Could not insert product in DB")
+        return product
+
     async def create_product(self, product: ProductModel) -> ProducDictModel:
         product = jsonable_encoder(product)
+        deadline.remaining(MONGO_LAYER)
         try:
-            await self.nosql_conn[self.config.products_collec].insert_one(
-                product
-            )
+            async with self._session() as session:
+                await self.nosql_conn[self.config.products_collec].insert_one(
+                    {**product, UPDATED_AT: datetime.utcnow()},
+                    session=session
+                )
         except (ConnectionFailure, ExecutionTimeout):
             raise InsertionError("Could not insert product in DB")
         return product
@@ -155,46 +388,281 @@ class Repository(RepositoryInterface):
     async def update_service(
         self,
         service_id: str,
-        service: ServiceUpdateModel
-    ):
+        service: ServiceUpdateModel,
+        expected_version: Optional[int] = None
+    ) -> ServiceDictModel:
         query = {"_id": service_id}
+        if expected_version is not None:
+            # Services stored before versioning have no field, take them
+            # as version 0
+            query["version"] = (
+                {"$in": [EMPTY_COUNT, None]}
+                if expected_version == EMPTY_COUNT
+                else expected_version
+            )
+        changes = service.dict(exclude_unset=True)
+        if changes.get("name") is not None:
+            changes[NAME_NORMALIZED] = normalize_text(changes["name"])
         values = {
-            "$set": service.dict(exclude_unset=True)
+            "$inc": {"version": 1},
+            "$set": {**changes, UPDATED_AT: datetime.utcnow()}
         }
+        collection = self.nosql_conn[self.config.services_collec]
         try:
-            await self.nosql_conn[self.config.services_collec].update_one(
-                query,
-                values
+            async with self._session() as session:
+                if changes:
+                    updated = await collection.find_one_and_update(
+                        query,
+                        values,
+                        projection={NAME_NORMALIZED: False},
+                        return_document=ReturnDocument.AFTER,
+                        session=session,
+                        **self._max_time()
+                    )
+                else:
+                    # Nothing to write, keep the version so clients holding
+                    # it do not get a conflict for nothing
+                    updated = await collection.find_one(
+                        query,
+                        {NAME_NORMALIZED: False},
+                        max_time_ms=deadline.remaining_ms(MONGO_LAYER),
+                        session=session
+                    )
+                if updated:
+                    return updated
+                if expected_version is not None and await collection.count_documents(  # noqa
+                    {"_id": service_id},
+                    limit=1,
+                    session=session,
+                    **self._max_time()
+                ):
+                    raise VersionConflictError(
+                        f"Service {service_id} is not in version {expected_version}"  # noqa
+                    )
+        except ExecutionTimeout:
+            raise deadline.exceeded(MONGO_LAYER)
+        except ConnectionFailure:
+            raise InsertionError("Could not update services in DB")
+        raise ElementNotFoundError("Service not found in DB")
+
+    def export_services(
+        self,
+        since_id: Optional[str] = None,
+        since: Optional[datetime] = None
+    ) -> AsyncIterator[ServiceDictModel]:
+        return self._export_collection(
+            self.config.services_collec,
+            since_id,
+            since
+        )
+
+    def export_products(
+        self,
+        since_id: Optional[str] = None,
+        since: Optional[datetime] = None
+    ) -> AsyncIterator[ProducDictModel]:
+        return self._export_collection(
+            self.config.products_collec,
+            since_id,
+            since
+        )
+
+    async def _export_collection(
+        self,
+        collection: str,
+        since_id: Optional[str],
+        since: Optional[datetime]
+    ) -> AsyncIterator[dict]:
+        # Ids are stored as ObjectId hex strings, so since_id resumes an
+        # export as an indexed range on _id
+        lower_bounds = []
+        if since_id is not None:
+            lower_bounds.append({"_id": {"$gt": since_id}})
+        if since is not None:
+            # Documents written before updated_at existed only have the
+            # creation time in their id
+            lower_bounds.append({"$or": [
+                {UPDATED_AT: {"$gte": since}},
+                {
+                    UPDATED_AT: {"$exists": False},
+                    "_id": {"$gte": str(ObjectId.from_datetime(since))}
+                }
+            ]})
+        query = {"$and": lower_bounds} if lower_bounds else {}
+        cursor = self._reads(collection, SEARCH_READS).find(
+            query,
+            {NAME_NORMALIZED: False},
+            batch_size=self.config.export_batch_size
+        ).sort("_id", ASCENDING)
+        try:
+            async for document in cursor:
+                yield document
+        except (ConnectionFailure, ExecutionTimeout):
+            raise DBConnectionError(
+                f"Could not export {collection} from DB"
+            )
+
+    async def load_query_stats(
+        self
+    ) -> List[Tuple[str, int, Optional[str]]]:
+        try:
+            stats = await self.nosql_conn[self.config.query_stats_collec].find_one(  # noqa
+                {"_id": QUERY_STATS_ID}
+            )
+        except (ConnectionFailure, ExecutionTimeout):
+            raise DBConnectionError("Could not load query stats from DB")
+        if not stats:
+            return []
+        return [tuple(entry) for entry in stats.get("counts", [])]
+
+    async def save_query_stats(
+        self,
+        stats: List[Tuple[str, int, Optional[str]]]
+    ):
+        # Stored as lists, search terms may not be valid field names
+        try:
+            await self.nosql_conn[self.config.query_stats_collec].replace_one(  # noqa
+                {"_id": QUERY_STATS_ID},
+                {"_id": QUERY_STATS_ID, "counts": [list(entry) for entry in stats]},  # noqa
+                upsert=True
+            )
+        except (ConnectionFailure, ExecutionTimeout):
+            raise InsertionError("Could not save query stats in DB")
+
+    async def count_services_to_adjust(
+        self,
+        adjustment: ServicePriceAdjustmentModel
+    ) -> int:
+        # Read like the update itself, a secondary could count a different
+        # set of services than the ones the real run modifies
+        services = self._reads(self.config.services_collec, ENTITY_READS)
+        try:
+            return await services.count_documents(
+                self._adjustment_query(adjustment),
+                **self._max_time()
             )
+        except ExecutionTimeout:
+            raise deadline.exceeded(MONGO_LAYER)
+        except ConnectionFailure:
+            raise DBConnectionError("Could not count services in DB")
+
+    async def find_services_to_adjust(
+        self,
+        adjustment: ServicePriceAdjustmentModel
+    ) -> AsyncIterator[ServiceDictModel]:
+        cursor = self.nosql_conn[self.config.services_collec].find(
+            self._adjustment_query(adjustment),
+            {"client_price": True, "real_price": True, "version": True},
+            batch_size=self.config.notify_batch_size
+        )
+        try:
+            async for service in cursor:
+                yield service
+        except (ConnectionFailure, ExecutionTimeout):
+            raise DBConnectionError("Could not find services in DB")
+
+    async def adjust_service_prices(
+        self,
+        adjustment: ServicePriceAdjustmentModel
+    ) -> Tuple[int, int]:
+        """Apply a price adjustment with a single update on the server
+
+        Returns:
+            Tuple[int, int]: services matched and modified
+        """
+        deadline.remaining(MONGO_LAYER)
+        try:
+            async with self._session() as session:
+                result = await self.nosql_conn[self.config.services_collec].update_many(  # noqa
+                    self._adjustment_query(adjustment),
+                    self._price_pipeline(adjustment),
+                    session=session
+                )
         except (ConnectionFailure, ExecutionTimeout):
             raise InsertionError("Could not update services in DB")
+        return result.matched_count, result.modified_count
 
     async def notify(
         self,
         service_product: Union[ServiceModel, ProductModel],
         _type: MessageType
+    ):
+        # Delivered before answering the request, so single changes travel
+        # in batches of one and only notify_many benefits from compression
+        await self._produce(service_product, _type)
+        await self._flush()
+
+    async def notify_many(
+        self,
+        services_products: List[Union[ServiceModel, ProductModel]],
+        _type: MessageType
+    ):
+        # A single flush lets the producer batch and compress them together
+        for service_product in services_products:
+            await self._produce(service_product, _type)
+        await self._flush()
+
+    async def _flush(self):
+        """Wait in a worker thread for queued messages to be delivered
+
+        Raises:
+            MessagingError: when some are still pending after the timeout
+        """
+        pending = await to_thread(
+            self.messaging_con.flush,
+            self.config.kafka_flush_timeout_ms / 1000
+        )
+        if pending:
+            raise MessagingError(f"{pending} messages were not delivered")
+
+    async def _produce(
+        self,
+        service_product: Union[ServiceModel, ProductModel],
+        _type: MessageType
     ):
         message = MessageFormat(
             type=_type.value,
             content=service_product)
-        self.messaging_con.produce(
-            self.config.kafka_topic,
-            message.json(encoder=str).encode("utf-8")
-        )
-        self.messaging_con.flush()
+        # Keyed by entity so every change of it lands in the same partition
+        queue_timeout = self.config.kafka_queue_full_timeout_ms / 1000
+        give_up = time.monotonic() + queue_timeout
+        while True:
+            try:
+                self.messaging_con.produce(
+                    self.config.kafka_topic,
+                    self.codec.encode(message),
+                    key=str(service_product.id).encode("utf-8"),
+                    headers=self.codec.headers()
+                )
+                return
+            except BufferError:
+                # Local queue is full, let deliveries drain it for a while
+                left = give_up - time.monotonic()
+                if left <= 0:
+                    raise MessagingError("Kafka local queue is full")
+                await to_thread(
+                    self.messaging_con.poll,
+                    min(left, 1)
+                )
 
     async def _get_token(self) -> str:
         headers = {
             "Content-Type": "application/x-www-form-urlencoded"
         }
         data = f"client_id={self.config.client_id}&client_secret={self.config.client_secret}&grant_type=client_credentials"  # noqa
+        # Out of budget has to surface as such, not as a TokenError
+        timeout = self._syscom_timeout()
         try:
-            response = requests.post(
+            response = await self._syscom_request(
+                "POST",
                 self.config.syscom_token_url,
+                timeout,
                 headers=headers,
                 data=data
             )
             response.raise_for_status()
+        except requests.Timeout:
+            raise deadline.exceeded(SYSCOM_LAYER)
         except Exception:
             raise TokenError("Problems while getting acces token")
         data = response.json()
@@ -202,3 +670,138 @@ class Repository(RepositoryInterface):
         if access_token:
             return access_token
         raise TokenError("Problems while getting acces token")
+
+    def _max_time(self) -> dict:
+        """maxTimeMS option for commands that take raw command options"""
+        max_time_ms = deadline.remaining_ms(MONGO_LAYER)
+        if max_time_ms is None:
+            return {}
+        return {"maxTimeMS": max_time_ms}
+
+    async def _syscom_request(
+        self,
+        method: str,
+        url: str,
+        timeout: float,
+        **kwargs
+    ) -> requests.Response:
+        """requests is blocking, run it in a worker thread so a slow Syscom
+        never stalls the event loop"""
+        return await to_thread(
+            requests.request,
+            method,
+            url,
+            timeout=timeout,
+            **kwargs
+        )
+
+    def _syscom_timeout(self) -> float:
+        timeout = self.config.syscom_timeout_ms / 1000
+        left = deadline.remaining(SYSCOM_LAYER)
+        if left is None:
+            return timeout
+        return min(left, timeout)
+
+    def _product_query(self, product_ids: List[str]) -> dict:
+        # Products are found by their own id or by the catalog product_id
+        catalog_ids = [int(pid) for pid in product_ids if pid.isdigit()]
+        return {
+            "$or": [
+                {"_id": {"$in": product_ids}},
+                {"product_id": {"$in": catalog_ids}},
+            ]
+        }
+
+    def _read_settings(
+        self,
+        read_preference: str,
+        max_staleness_s: int,
+        read_concern: Optional[str]
+    ) -> Dict:
+        # Primary reads are never stale and take no staleness bound
+        if read_preference == "primary":
+            max_staleness_s = -1
+        return {
+            "read_preference": make_read_preference(
+                read_pref_mode_from_name(read_preference),
+                None,
+                max_staleness_s
+            ),
+            "read_concern": ReadConcern(read_concern),
+        }
+
+    def _reads(self, collection: str, workload: str) -> AsyncIOMotorCollection:
+        """Collection that routes reads as configured for the workload"""
+        return self.nosql_conn.get_collection(
+            collection,
+            **self.read_settings[workload]
+        )
+
+    @asynccontextmanager
+    async def _session(self) -> AsyncIterator[AsyncIOMotorClientSession]:
+        """Causally consistent session that follows the last write made by
+        this instance, so reads after it see it even on a secondary.
+        Yields None when causal consistency is disabled"""
+        if not self.config.causal_consistency:
+            yield None
+            return
+        client = self.nosql_conn.client
+        async with await client.start_session(
+            causal_consistency=True
+        ) as session:
+            if self.cluster_time is not None:
+                session.advance_cluster_time(self.cluster_time)
+            if self.operation_time is not None:
+                session.advance_operation_time(self.operation_time)
+            yield session
+            if session.cluster_time is not None and (
+                self.cluster_time is None
+                or session.cluster_time["clusterTime"]
+                > self.cluster_time["clusterTime"]
+            ):
+                self.cluster_time = session.cluster_time
+            if session.operation_time is not None and (
+                self.operation_time is None
+                or session.operation_time > self.operation_time
+            ):
+                self.operation_time = session.operation_time
+
+    def _adjustment_query(
+        self,
+        adjustment: ServicePriceAdjustmentModel
+    ) -> dict:
+        conditions = []
+        if adjustment.ids:
+            conditions.append({"_id": {"$in": adjustment.ids}})
+        if adjustment.name:
+            conditions.append(
+                {"name": {"$regex": adjustment.name, "$options": "mxsi"}}
+            )
+        if adjustment.description:
+            conditions.append(
+                {
+                    "description": {
+                        "$regex": adjustment.description,
+                        "$options": "mxsi"
+                    }
+                }
+            )
+        return {"$and": conditions}
+
+    def _price_pipeline(
+        self,
+        adjustment: ServicePriceAdjustmentModel
+    ) -> List[dict]:
+        """Aggregation pipeline update computing the same formulas as
+        ServicePriceAdjustmentModel.apply"""
+        new_prices = {}
+        for price, (source, factor, addend) in adjustment.formulas().items():
+            scaled = {"$multiply": [f"${source}", factor]}
+            expression = {"$max": [{"$add": [scaled, addend]}, 0]}
+            new_prices[price] = {"$round": [expression, 2]}
+        version = {"$add": [{"$ifNull": ["$version", EMPTY_COUNT]}, 1]}
+        return [{"$set": {
+            **new_prices,
+            "version": version,
+            UPDATED_AT: datetime.utcnow()
+        }}]
@@ -1,5 +1,6 @@
 from enum import Enum
-from typing import Any, List
+from datetime import datetime
+from typing import Any, AsyncIterator, List, Optional
 from abc import ABC, abstractmethod
 
 
@@ -16,6 +17,17 @@ class RepositoryInterface(ABC):
             Any: Service data got
         """
 
+    @abstractmethod
+    async def get_service_version(self, service_id: str) -> int:
+        """Get the current version of a service
+
+        Args:
+            service_id (str): id of the service
+
+        Returns:
+            int: Service version
+        """
+
     @abstractmethod
     async def get_product_data(self, product_id: int) -> Any:
         """Get information about a product
@@ -27,6 +39,28 @@ class RepositoryInterface(ABC):
             Any: Information about the product
         """
 
+    @abstractmethod
+    async def get_products_data(self, product_ids: List[str]) -> List[Any]:
+        """Get information about several products
+
+        Args:
+            product_ids (List[str]): product ids
+
+        Returns:
+            List[Any]: products found, missing ones are left out
+        """
+
+    @abstractmethod
+    async def fetch_product(self, product_id: str) -> Any:
+        """Get information about a product from the catalog provider
+
+        Args:
+            product_id (str): catalog product id
+
+        Returns:
+            Any: Catalog information about the product
+        """
+
     @abstractmethod
     async def search_products(self, word: str) -> List[Any]:
         """Word to search into product catalog
@@ -63,6 +97,27 @@ class RepositoryInterface(ABC):
             List[Any]: List of services matches
         """
 
+    @abstractmethod
+    async def autocomplete_services(
+        self,
+        prefix: str,
+        limit: int
+    ) -> List[Any]:
+        """Services whose name starts with a prefix, ignoring case and
+        accents
+
+        Args:
+            prefix (str): start of the service name
+            limit (int): max number of services to return
+
+        Returns:
+            List[Any]: services ordered by name
+        """
+
+    @abstractmethod
+    async def create_indexes(self):
+        """Create the indexes queries rely on"""
+
     @abstractmethod
     async def create_service(self, service: Any) -> Any:
         """Create service in DB
@@ -74,6 +129,17 @@ class RepositoryInterface(ABC):
             Any: Service updated
         """
 
+    @abstractmethod
+    async def save_product(self, product: Any) -> Any:
+        """Store a catalog product unless it is already in DB
+
+        Args:
+            product (Any): product to store
+
+        Returns:
+            Any: product stored
+        """
+
     @abstractmethod
     async def create_product(self, product: Any) -> Any:
         """Create a product in DB
@@ -86,15 +152,108 @@ class RepositoryInterface(ABC):
         """
 
     @abstractmethod
-    async def update_service(self, service_id: str, service: Any) -> Any:
-        """Update service in DB
+    async def update_service(
+        self,
+        service_id: str,
+        service: Any,
+        expected_version: Optional[int] = None
+    ) -> Any:
+        """Update service in DB in a single operation, the version is only
+        increased when there is something to change
 
         Args:
             service_id (str): service id to update data
             service (Any): service to update
+            expected_version (Optional[int]): only update when the service
+                is still in this version
 
         Returns:
-            Any: Service updated
+            Any: Service updated, with its new version
+        """
+
+    @abstractmethod
+    def export_services(
+        self,
+        since_id: Optional[str] = None,
+        since: Optional[datetime] = None
+    ) -> AsyncIterator[Any]:
+        """Iterate over every service in DB without loading them in memory
+
+        Args:
+            since_id (Optional[str]): only services created after this id
+            since (Optional[datetime]): only services created or changed
+                since this date
+
+        Returns:
+            AsyncIterator[Any]: services ordered by id
+        """
+
+    @abstractmethod
+    def export_products(
+        self,
+        since_id: Optional[str] = None,
+        since: Optional[datetime] = None
+    ) -> AsyncIterator[Any]:
+        """Iterate over every product in DB without loading them in memory
+
+        Args:
+            since_id (Optional[str]): only products created after this id
+            since (Optional[datetime]): only products created or changed
+                since this date
+
+        Returns:
+            AsyncIterator[Any]: products ordered by id
+        """
+
+    @abstractmethod
+    async def load_query_stats(self) -> List[Any]:
+        """Load the last saved search popularity counts
+
+        Returns:
+            List[Any]: search key, count and last term searched with it
+        """
+
+    @abstractmethod
+    async def save_query_stats(self, stats: List[Any]):
+        """Save search popularity counts
+
+        Args:
+            stats (List[Any]): search key, count and last term searched
+                with it
+        """
+
+    @abstractmethod
+    async def count_services_to_adjust(self, adjustment: Any) -> int:
+        """Count the services a price adjustment applies to
+
+        Args:
+            adjustment (Any): price adjustment
+
+        Returns:
+            int: number of services matched
+        """
+
+    @abstractmethod
+    def find_services_to_adjust(self, adjustment: Any) -> AsyncIterator[Any]:
+        """Iterate over the current prices of the services a price
+        adjustment applies to
+
+        Args:
+            adjustment (Any): price adjustment
+
+        Returns:
+            AsyncIterator[Any]: services with id, prices and version
+        """
+
+    @abstractmethod
+    async def adjust_service_prices(self, adjustment: Any) -> Any:
+        """Apply a price adjustment to every service it matches
+
+        Args:
+            adjustment (Any): price adjustment
+
+        Returns:
+            Any: services matched and modified
         """
 
     @abstractmethod
@@ -106,3 +265,13 @@ class RepositoryInterface(ABC):
             service_product (Any): Service or product to notify
 
         """
+
+    @abstractmethod
+    async def notify_many(self, services_products: List[Any], _type: Enum):
+        """Notification about several services or products changes in
+        messaging system, sent as a batch
+
+        Args:
+            services_products (List[Any]): Services or products to notify
+
+        """
@@ -0,0 +1,47 @@
+"""Fill name_normalized for services stored before autocomplete existed
+
+    python -m app.migrations.backfill_service_names
+"""
+import asyncio
+import logging
+
+from app.config import Config
+from app.connections import create_connection
+from app.infrastructure.normalization import normalize_text
+from app.infrastructure.repository import NAME_NORMALIZED
+
+from pymongo import UpdateOne
+
+
+log = logging.getLogger(__name__)
+
+
+async def backfill(batch_size: int = 500) -> int:
+    conf = Config()
+    collection = create_connection()[conf.services_collec]
+    cursor = collection.find(
+        {NAME_NORMALIZED: {"$exists": False}},
+        {"name": True},
+        batch_size=batch_size
+    )
+    updated = 0
+    batch = []
+    async for service in cursor:
+        batch.append(UpdateOne(
+            {"_id": service["_id"]},
+            {"$set": {NAME_NORMALIZED: normalize_text(service.get("name"))}}
+        ))
+        if len(batch) == batch_size:
+            result = await collection.bulk_write(batch, ordered=False)
+            updated += result.modified_count
+            batch = []
+    if batch:
+        result = await collection.bulk_write(batch, ordered=False)
+        updated += result.modified_count
+    await collection.create_index([(NAME_NORMALIZED, 1)])
+    return updated
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    log.info(f"Backfilled {asyncio.run(backfill())} services")
@@ -0,0 +1,88 @@
+import sys
+import time
+import asyncio
+import logging
+import threading
+import traceback
+from typing import Optional
+
+from app.metrics import Counter, Histogram
+
+
+log = logging.getLogger(__name__)
+
+loop_lag = Histogram(
+    "event_loop_lag_seconds",
+    "Delay between when the lag probe should run and when it runs",
+    (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+)
+loop_blocked = Counter(
+    "event_loop_blocked_total",
+    "Times the event loop was blocked longer than the threshold"
+)
+
+
+class LoopLagMonitor:
+    """Measures how late the event loop runs a periodic probe. A watchdog
+    thread notices when the probe stops running because something blocks
+    the loop, and logs the stack of the blocking code while it happens."""
+
+    def __init__(
+        self,
+        interval_ms: int,
+        threshold_ms: int,
+        log_interval_s: int
+    ):
+        self.interval = interval_ms / 1000
+        self.threshold = threshold_ms / 1000
+        self.log_interval = log_interval_s
+        self._heartbeat = time.monotonic()
+        self._last_log = -float(log_interval_s)
+        self._loop_thread_id: Optional[int] = None
+        self._probe: Optional[asyncio.Task] = None
+        self._stopped = threading.Event()
+        self._watchdog = threading.Thread(target=self._watch, daemon=True)
+
+    def start(self):
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._probe = asyncio.create_task(self._measure())
+        self._watchdog.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._probe is not None:
+            self._probe.cancel()
+
+    async def _measure(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            scheduled = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            loop_lag.observe(max(loop.time() - scheduled, 0))
+            self._heartbeat = time.monotonic()
+
+    def _watch(self):
+        blocked = False
+        while not self._stopped.wait(self.interval):
+            stalled = time.monotonic() - self._heartbeat - self.interval
+            if stalled < self.threshold:
+                blocked = False
+                continue
+            if blocked:
+                # Same stall as the last check, already reported
+                continue
+            blocked = True
+            loop_blocked.inc()
+            self._report(stalled)
+
+    def _report(self, stalled: float):
+        now = time.monotonic()
+        if now - self._last_log < self.log_interval:
+            return
+        self._last_log = now
+        frame = sys._current_frames().get(self._loop_thread_id)
+        stack = "".join(traceback.format_stack(frame)) if frame else ""
+        log.warning(
+            f"Event loop blocked for {stalled * 1000:.0f} ms at:\n{stack}"
+        )
@@ -0,0 +1,247 @@
+import sys
+import time
+import asyncio
+import uuid
+import secrets
+import logging
+import threading
+from types import FrameType
+from contextvars import ContextVar
+from collections import Counter, OrderedDict, deque
+from typing import Callable, Deque, List, Optional, Set
+
+from app.metrics import Counter as MetricCounter
+
+
+log = logging.getLogger(__name__)
+
+PROFILE_TOKEN_HEADER = b"x-profile-token"
+PROFILE_ID_HEADER = b"x-profile-id"
+PROFILES_PATH = "/api/v1/profiles"
+
+_profiler: ContextVar[Optional["SamplingProfiler"]] = ContextVar(
+    "profiler",
+    default=None
+)
+
+profiles_taken = MetricCounter(
+    "profiles_total",
+    "Profiling requests, by outcome"
+)
+
+
+class SamplingProfiler:
+    """Samples what one request is doing from a background thread and keeps
+    it in folded format ("frame;frame;frame count"), readable by
+    flamegraph.pl and speedscope.
+
+    Each sample is the stack of the request task: the running frames of the
+    event loop thread while it runs, the coroutines it is awaiting in while
+    it is suspended. Blocking calls sent to worker threads with to_thread
+    are sampled too, under the await that waits for them.
+    """
+
+    def __init__(self, task: asyncio.Task, thread_id: int, interval: float):
+        self.task = task
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self._workers: Set[int] = set()
+        self._workers_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+
+    def start(self):
+        self._sampler.start()
+
+    def stop(self) -> str:
+        self._stopped.set()
+        self._sampler.join()
+        return "".join(
+            f"{stack} {count}\n" for stack, count in self.stacks.items()
+        )
+
+    def run_sampled(self, func: Callable, *args, **kwargs):
+        """Run func in the calling worker thread, sampling it meanwhile"""
+        thread_id = threading.get_ident()
+        with self._workers_lock:
+            self._workers.add(thread_id)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            with self._workers_lock:
+                self._workers.discard(thread_id)
+
+    def _sample(self):
+        while not self._stopped.wait(self.interval):
+            frames = sys._current_frames()
+            request = self._request_frames(frames.get(self.thread_id))
+            with self._workers_lock:
+                workers = list(self._workers)
+            for thread_id in workers:
+                worker = _frames(frames.get(thread_id))
+                # Leave out the executor machinery up to run_sampled
+                for position, frame in enumerate(worker):
+                    if frame.f_code is _RUN_SAMPLED:
+                        worker = worker[position + 1:]
+                        break
+                if worker:
+                    self._add(request + worker)
+            if not workers and request:
+                self._add(request)
+
+    def _request_frames(self, loop_frame) -> List[FrameType]:
+        awaiting = _await_frames(self.task.get_coro())
+        if not awaiting:
+            return []
+        # While the task runs its frames are on the loop thread, along with
+        # the synchronous calls they made
+        running = _frames(loop_frame)
+        for position, frame in enumerate(running):
+            if frame is awaiting[0]:
+                return running[position:]
+        return awaiting
+
+    def _add(self, frames: List[FrameType]):
+        self.stacks[";".join(
+            f"{frame.f_code.co_name} "
+            f"({frame.f_code.co_filename}:{frame.f_lineno})"
+            for frame in frames
+        )] += 1
+
+
+_RUN_SAMPLED = SamplingProfiler.run_sampled.__code__
+
+
+def _frames(frame: Optional[FrameType]) -> List[FrameType]:
+    """Frames of a thread stack, outermost first"""
+    frames = []
+    while frame is not None:
+        frames.append(frame)
+        frame = frame.f_back
+    frames.reverse()
+    return frames
+
+
+def _await_frames(coro) -> List[FrameType]:
+    """Frames of a coroutine and the ones it is awaiting, outermost first"""
+    frames = []
+    while coro is not None:
+        frame = getattr(coro, "cr_frame", None) or getattr(
+            coro, "gi_frame", None
+        )
+        if frame is None:
+            break
+        frames.append(frame)
+        coro = getattr(coro, "cr_await", None) or getattr(
+            coro, "gi_yieldfrom", None
+        )
+    return frames
+
+
+async def to_thread(func: Callable, *args, **kwargs):
+    """asyncio.to_thread that lets the profile of the current request, when
+    it has one, sample the worker thread while it runs func"""
+    profiler = _profiler.get()
+    if profiler is None:
+        return await asyncio.to_thread(func, *args, **kwargs)
+    return await asyncio.to_thread(
+        profiler.run_sampled, func, *args, **kwargs
+    )
+
+
+class ProfileRegistry:
+    """Who may profile, how often, and the last profiles taken"""
+
+    def __init__(
+        self,
+        token: Optional[str],
+        interval_ms: int,
+        max_per_minute: int,
+        keep: int
+    ):
+        self.token = token.encode("utf-8") if token else None
+        self.interval = max(interval_ms, 1) / 1000
+        self.max_per_minute = max_per_minute
+        self.keep = keep
+        self.profiles: "OrderedDict[str, str]" = OrderedDict()
+        self._started: Deque[float] = deque()
+        self._running = False
+
+    @property
+    def enabled(self) -> bool:
+        return self.token is not None
+
+    def is_authorized(self, token: Optional[bytes]) -> bool:
+        if self.token is None or token is None:
+            return False
+        return secrets.compare_digest(token, self.token)
+
+    def acquire(self) -> bool:
+        # Only called from the event loop thread, no lock needed
+        now = time.monotonic()
+        while self._started and now - self._started[0] > 60:
+            self._started.popleft()
+        if self._running or len(self._started) >= self.max_per_minute:
+            return False
+        self._started.append(now)
+        self._running = True
+        return True
+
+    def release(self, profile_id: str, profile: str):
+        self._running = False
+        self.profiles[profile_id] = profile
+        while len(self.profiles) > self.keep:
+            self.profiles.popitem(last=False)
+
+    def get(self, profile_id: str) -> Optional[str]:
+        return self.profiles.get(profile_id)
+
+
+class ProfilingMiddleware:
+    """Profiles a single request when it carries the X-Profile-Token header
+    with the configured token, the profile id is returned in X-Profile-Id.
+
+    Requests without the header only pay for a header lookup.
+    """
+
+    def __init__(self, app, registry: ProfileRegistry):
+        self.app = app
+        self.registry = registry
+
+    async def __call__(self, scope, receive, send):
+        if not self.registry.enabled or scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        token = dict(scope["headers"]).get(PROFILE_TOKEN_HEADER)
+        if token is None or scope["path"].startswith(PROFILES_PATH):
+            return await self.app(scope, receive, send)
+        if not self.registry.is_authorized(token):
+            profiles_taken.inc(outcome="unauthorized")
+            return await self.app(scope, receive, send)
+        if not self.registry.acquire():
+            profiles_taken.inc(outcome="rate_limited")
+            log.warning("Profiling request skipped, rate limit reached")
+            return await self.app(scope, receive, send)
+
+        profile_id = uuid.uuid4().hex
+
+        async def send_with_profile_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + [
+                    (PROFILE_ID_HEADER, profile_id.encode("utf-8"))
+                ]
+            await send(message)
+
+        profiler = SamplingProfiler(
+            asyncio.current_task(),
+            threading.get_ident(),
+            self.registry.interval
+        )
+        current = _profiler.set(profiler)
+        profiler.start()
+        try:
+            await self.app(scope, receive, send_with_profile_id)
+        finally:
+            _profiler.reset(current)
+            self.registry.release(profile_id, profiler.stop())
+            profiles_taken.inc(outcome="taken")
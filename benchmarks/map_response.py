@@ -0,0 +1,68 @@
+"""Microbenchmark of Syscom search payload mapping
+
+Compares building a ProductModel per item, as the gateway used to do,
+against the precompiled plan used now.
+
+    python -m benchmarks.map_response [items] [repeat]
+"""
+import sys
+import timeit
+
+from app.adapters.mappers import map_syscom_products
+from app.entities.models import ProductModel
+
+
+def build_payload(items: int) -> list:
+    return [
+        {
+            "producto_id": 10000 + i,
+            "modelo": f"MOD-{i}",
+            "total_existencia": 12,
+            "titulo": f"Camara IP {i}",
+            "marca": "Hikvision",
+            "sat_key": 46171610,
+            "img_portada": f"https://example.com/{i}.jpg",
+            "peso": 1.25,
+            "existencia": {"nuevo": 12, "asterisco": {}},
+            "precios": {
+                "precio_1": 120.5,
+                "precio_especial": 110.0,
+                "precio_descuento": 99.9,
+                "precio_lista": 130.0,
+            },
+        }
+        for i in range(items)
+    ]
+
+
+def pydantic_mapping(raw_data: list) -> list:
+    return [
+        ProductModel(
+            title=prs.get("titulo"),
+            list_price=prs.get("precios").get("precio_lista"),
+            discount_price=prs.get("precios").get("precio_descuento"),
+            image=prs.get("img_portada"),
+            stock_number=prs.get("existencia").get("nuevo"),
+            brand=prs.get("marca"),
+            product_id=prs.get("producto_id"),
+            model=prs.get("modelo"),
+            sat_key=prs.get("sat_key"),
+            weight=prs.get("peso"),
+        ) for prs in raw_data
+    ]
+
+
+def main(items: int = 10_000, repeat: int = 5):
+    payload = build_payload(items)
+    for name, mapper in (
+        ("pydantic", pydantic_mapping),
+        ("plan", map_syscom_products),
+    ):
+        best = min(
+            timeit.repeat(lambda: mapper(payload), number=1, repeat=repeat)
+        )
+        print(f"{name:>8}: {best * 1000:8.2f} ms for {items} items")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:3]))
@@ -0,0 +1,61 @@
+"""Encode/decode throughput and payload size of the Kafka message codecs
+
+    python -m benchmarks.message_codecs [messages] [repeat]
+"""
+import sys
+import timeit
+import zlib
+
+from app.entities.models import MessageFormat, MessageType, ProductModel
+from app.infrastructure.codecs import CODECS
+
+
+def build_messages(count: int) -> list:
+    return [
+        MessageFormat(
+            type=MessageType.product.value,
+            content=ProductModel(
+                title=f"Camara IP {i}",
+                list_price=130.0,
+                discount_price=99.9,
+                image=f"https://example.com/{i}.jpg",
+                stock_number=12,
+                brand="Hikvision",
+                product_id=10000 + i,
+                model=f"MOD-{i}",
+                sat_key=46171610,
+                weight=1.25,
+            )
+        )
+        for i in range(count)
+    ]
+
+
+def main(count: int = 10_000, repeat: int = 5):
+    messages = build_messages(count)
+    for name, codec_class in CODECS.items():
+        codec = codec_class()
+        payloads = [codec.encode(message) for message in messages]
+        encode = min(timeit.repeat(
+            lambda: [codec.encode(message) for message in messages],
+            number=1,
+            repeat=repeat
+        ))
+        decode = min(timeit.repeat(
+            lambda: [codec.decode(payload) for payload in payloads],
+            number=1,
+            repeat=repeat
+        ))
+        size = sum(len(payload) for payload in payloads)
+        # Kafka compresses whole batches, approximate it with one block
+        batch = len(zlib.compress(b"".join(payloads)))
+        print(
+            f"{name:>8}: encode {count / encode:10.0f} msg/s"
+            f" | decode {count / decode:10.0f} msg/s"
+            f" | {size / count:6.1f} B/msg"
+            f" | {batch / count:6.1f} B/msg compressed"
+        )
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:3]))